@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 Example script for Cantemo Agent using mediainfo for media parameters.
 
@@ -10,35 +10,52 @@ Depends on "mediainfo" executable - available for Mac from https://mediaarea.net
 or with brew: "brew install media-info"
 
 Please check that MEDIAINFO_EXECUTABLE is valid if command fails.
+
+The files of a file_ready request are checked MEDIAINFO_WORKERS at a time, and a file for which
+mediainfo does not finish in MEDIAINFO_TIMEOUT seconds fails without holding up the others.
+
+The video properties and the result of each file are saved in an SQLite database, CACHE_FILENAME, so
+a file sent again with the same size and modification time is not checked with mediainfo again. The
+CACHE_MAX_ENTRIES most recently used files are kept. Delete the database after changing the checks.
 """
 
 import json
 import logging
 import os
 import select
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Path to mediainfo executable
 MEDIAINFO_EXECUTABLE = '/usr/local/bin/mediainfo'
 
+# Number of mediainfo processes run at the same time
+MEDIAINFO_WORKERS = 4
+
+# Fields read from the first video track
+MEDIAINFO_VIDEO_FIELDS = ['Width', 'Height', 'Rotation']
+
+# Seconds after which mediainfo is stopped, e.g. on a hung network share or a corrupt file
+MEDIAINFO_TIMEOUT = 60
+
 # Setup logging into a file in same directory as source file
 basedir = os.path.abspath(os.path.dirname(__file__))
 log_filename = os.path.join(basedir, 'mac_agent_check_mediainfo.log')
-logging.basicConfig(
-    filename=log_filename,
-    format='%(asctime)s - %(process)d - %(levelname)s: %(message)s',
-    level=logging.DEBUG)
-log = logging.getLogger(__name__)
 
-data_in = None
+# Cache of checked files in same directory as source file, None to disable
+CACHE_FILENAME = os.path.join(basedir, 'mac_agent_check_mediainfo_cache.db')
 
-# Check if there is incoming data on STDIN and read it
-r_list, w_list, x_list = select.select([sys.stdin], [], [], 0)
-log.debug('Start - r_list: %r - args: %r - os.getcwd(): %s', r_list, sys.argv, os.getcwd())
-if r_list:
-    data_in = sys.stdin.read()
-log.debug('Started - data in: %r', data_in)
+# Number of files kept in the cache, the least recently used are removed
+CACHE_MAX_ENTRIES = 10000
+
+# Include the inode in the identity of a file. Disable if the inodes are not stable, e.g. on some network shares
+CACHE_USE_INODE = True
+
+log = logging.getLogger(__name__)
 
 
 def write_status(data):
@@ -56,30 +73,31 @@ def write_status(data):
 
 def get_mediainfo_output(path):
     """
-    Get output of MediaInfo for a given file
+    Get the MEDIAINFO_VIDEO_FIELDS of the first video track of a given file from MediaInfo
+
+    Only these fields are output by mediainfo, with an --Inform template, as raw values which do not
+    depend on the locale, e.g. Width 1920 instead of "1 920 pixels".
 
     :param path: Full path to media file, including filename
-    :return: A dict with all info fields as output by mediainfo - e.g. {'Video':{'Width':'1 920 pixels'}, ...
-             None if mediainfo failed or there was some error parsing the results
+    :return: A dict with the fields, e.g. {'Width': '1920', 'Height': '1080', 'Rotation': '90.000'}, values
+             are '' if not available. An empty dict if there is no video track.
+             None if mediainfo failed
     """
     log.debug('get_mediainfo_output, path: %r', path)
+    template = 'Video;' + '|'.join('%%%s%%' % field for field in MEDIAINFO_VIDEO_FIELDS) + '\\n'
     result = None
     try:
-        result = subprocess.check_output([MEDIAINFO_EXECUTABLE, path])
-        info = {}
-        current_header = None
-        for line in result.splitlines():
-            if not line:
-                continue
-            if ':' not in line:
-                current_header = line
-                info[current_header] = {}
-            else:
-                key, value = line.split(':', 1)
-                key = key.strip()
-                value = value.strip()
-                info[current_header][key] = value
-        return info
+        result = subprocess.run(
+            [MEDIAINFO_EXECUTABLE, '--Inform=' + template, path], stdout=subprocess.PIPE, universal_newlines=True,
+            check=True, timeout=MEDIAINFO_TIMEOUT).stdout
+        # One line per video track
+        lines = result.splitlines()
+        if not lines or not lines[0]:
+            return {}
+        return dict(zip(MEDIAINFO_VIDEO_FIELDS, lines[0].split('|')))
+    except subprocess.TimeoutExpired:
+        log.error("mediainfo did not finish in %s seconds: %r", MEDIAINFO_TIMEOUT, path)
+        return None
     except Exception:
         log.exception("Failed to run mediainfo, output: %s", result)
         return None
@@ -94,10 +112,8 @@ def get_video_width_height(mediainfo):
     """
     width = height = None
     try:
-        width_str = mediainfo['Video']['Width']
-        height_str = mediainfo['Video']['Height']
-        width = int(width_str.replace('pixels', '').replace(' ', ''))
-        height = int(height_str.replace('pixels', '').replace(' ', ''))
+        width = int(mediainfo['Width'])
+        height = int(mediainfo['Height'])
     except (KeyError, ValueError) as e:
         log.warning("Could not get video width/height: %s", e)
     return width, height
@@ -108,59 +124,210 @@ def get_video_rotation(mediainfo):
     Get rotation angle value
 
     :param mediainfo: dict from get_mediainfo_output()
-    :return: Angle value, e.g. '270\xc2\xb0' or '00\xc2\xb0' - None if not found
+    :return: Angle value in degrees, e.g. '270.000' or '0.000' - None if not found
     """
-    try:
-        return mediainfo['Video']['Rotation']
-    except KeyError:
-        return None
+    return mediainfo.get('Rotation') or None
+
+
+class ProbeCache(object):
+    """
+    SQLite database with the video properties and result of checked files, by path, size, modification
+    time and inode.
+    """
+    def __init__(self, filename):
+        # Used by the threads checking the files, one at a time. The timeout waits for other instances of
+        # the script using the same database.
+        self.db = sqlite3.connect(filename, timeout=10, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('CREATE TABLE IF NOT EXISTS probe (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                        'inode INTEGER, mediainfo TEXT, status TEXT, message TEXT, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS probe_last_used ON probe (last_used)')
+        self.db.commit()
+
+    @staticmethod
+    def get_identity(path):
+        """
+        :return: (size, mtime, inode) of the file, None if it cannot be read
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino if CACHE_USE_INODE else 0
+
+    def get(self, path, identity):
+        """
+        :return: (mediainfo, status, message) saved for the file, None if not saved or the file has changed
+        """
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, inode, mediainfo, status, message FROM probe WHERE path = ?',
+                                  (path,)).fetchone()
+            if row is None or tuple(row[:3]) != identity:
+                return None
+            self.db.execute('UPDATE probe SET last_used = ? WHERE path = ?', (time.time(), path))
+            self.db.commit()
+        return json.loads(row[3]), row[4], row[5]
+
+    def put(self, path, identity, mediainfo, status, message):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (path,) + identity + (json.dumps(mediainfo), status, message, time.time()))
+            self.db.commit()
+
+    def evict(self):
+        """
+        Remove all but the CACHE_MAX_ENTRIES most recently used files.
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM probe WHERE path NOT IN '
+                            '(SELECT path FROM probe ORDER BY last_used DESC LIMIT ?)', (CACHE_MAX_ENTRIES,))
+            self.db.commit()
+
+
+probe_cache = None
+
+
+def get_log_name():
+    """
+    Name of the log file of this process, which is another one than log_filename when this is imported, e.g.
+    by mac_agent_validation_pipeline.py or mac_agent_helper_daemon.py
+    """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            return os.path.basename(handler.baseFilename)
+    return os.path.basename(log_filename)
+
+
+def check_file(f):
+    """
+    Check a file with mediainfo
+
+    :param f: File dict from the request, status and message are set on it
+    :return: f
+    """
+    identity = None
+    if probe_cache:
+        identity = ProbeCache.get_identity(f['path'])
+    if identity:
+        try:
+            cached = probe_cache.get(f['path'], identity)
+        except sqlite3.Error:
+            log.exception('Failed to read cache')
+            cached = None
+        if cached:
+            log.debug('Cached MediaInfo: %r', cached)
+            _, f['status'], f['message'] = cached
+            return f
+
+    mediainfo = get_mediainfo_output(f['path'])
+    log.debug('MediaInfo: %r', mediainfo)
+    # Default to failed
+    f['status'] = 'failed'
+    if mediainfo is None:
+        # Not cached, mediainfo may succeed next time
+        f['message'] = 'Failed to get media info - see %s for details' % get_log_name()
+        return f
+
+    video_width, video_height = get_video_width_height(mediainfo)
+    rotation = get_video_rotation(mediainfo)
+    log.debug('Video width: %s, height: %s, rotation: %r', video_width, video_height, rotation)
+
+    if not video_width or not video_height:
+        f['message'] = 'Not a video file: Invalid width %s or height %s' % (video_width, video_height)
+    else:
+        # Check for rotation in video
+        if rotation and (rotation.startswith('270') or rotation.startswith('90')):
+            # Swap width/height for comparison
+            log.debug('Rotation detected, swapping width/height')
+            video_width, video_height = video_height, video_width
+
+        if video_height < 1080:
+            f['message'] = 'Video resolution is too low, not Full HD (%s)' % video_height
+        elif video_height > video_width:
+            f['message'] = 'Vertical videos not allowed: %s < %s' % (video_width, video_height)
+        else:
+            f['status'] = 'ok'
+            f['message'] = 'Video approved - resolution %sx%s' % (video_width, video_height)
 
+    if identity:
+        try:
+            probe_cache.put(f['path'], identity, mediainfo, f['status'], f['message'])
+        except sqlite3.Error:
+            log.exception('Failed to save to cache')
+    return f
+
+
+def get_probe_cache():
+    """
+    Open the cache on first use, it is then kept open, e.g. in mac_agent_helper_daemon.py
+
+    :return: ProbeCache, None if disabled or it cannot be opened
+    """
+    global probe_cache
+    if probe_cache is None and CACHE_FILENAME:
+        try:
+            probe_cache = ProbeCache(CACHE_FILENAME)
+        except sqlite3.Error:
+            log.exception('Failed to open cache %s, checking all files', CACHE_FILENAME)
+    return probe_cache
+
+
+def handle_request(data_in):
+    """
+    Handle a request from the Agent
+
+    :param data_in: Data read from stdin, None if there was none
+    :return: Response dict
+    """
+    if not data_in:
+        # No input - give API level response so Agent can detect support
+        return {'api_version': 2, 'app_name': 'Check Mediainfo'}
 
-if not data_in:
-    # No input - give API level response so Agent can detect support
-    write_status({'api_version': 2, 'app_name': 'Check Mediainfo'})
-else:
     # Else return status per file
     request = json.loads(data_in)
     operation = request.get('operation')
 
     if operation == 'file_ready':
-        # Files are ready and readable - check with mediainfo
+        # Files are ready and readable - check with mediainfo, results in the same order as the files
         files = request.get('files', [])
-        for f in files:
-            mediainfo = get_mediainfo_output(f['path'])
-            log.debug('MediaInfo: %r', mediainfo)
-            # Default to failed
-            f['status'] = 'failed'
-            if not mediainfo:
-                f['message'] = 'Failed to get media info - see mac_agent_check_mediainfo.log for details'
-            else:
-                video_width, video_height = get_video_width_height(mediainfo)
-                rotation = get_video_rotation(mediainfo)
-                log.debug('Video width: %s, height: %s, rotation: %r', video_width, video_height, rotation)
-
-                if not video_width or not video_height:
-                    f['message'] = 'Not a video file: Invalid width %s or height %s' % (video_width, video_height)
-                else:
-                    # Check for rotation in video
-                    if rotation and (rotation.startswith('270') or rotation.startswith('90')):
-                        # Swap width/height for comparison
-                        log.debug('Rotation detected, swapping width/height')
-                        video_width, video_height = video_height, video_width
-
-                    if video_height < 1080:
-                        f['message'] = 'Video resolution is too low, not Full HD (%s)' % video_height
-                    elif video_height > video_width:
-                        f['message'] = 'Vertical videos not allowed: %s < %s' % (video_width, video_height)
-                    else:
-                        f['status'] = 'ok'
-                        f['message'] = 'Video approved - resolution %sx%s' % (video_width, video_height)
-
-        write_status({'status': 'done', 'files': files})
-    else:
-        # Any other operation - do not accept or decline any files
-        # ESPECIALLY we don't want to "approve" if "file_new" happens to come *after* file_ready.
-        # Note: This script does not handle "open_with", so "Open with..." from Portal will not do anything.
-        write_status({})
+        get_probe_cache()
+        with ThreadPoolExecutor(max_workers=MEDIAINFO_WORKERS) as executor:
+            files = list(executor.map(check_file, files))
+        return {'status': 'done', 'files': files}
+
+    # Any other operation - do not accept or decline any files
+    # ESPECIALLY we don't want to "approve" if "file_new" happens to come *after* file_ready.
+    # Note: This script does not handle "open_with", so "Open with..." from Portal will not do anything.
+    return {}
+
+
+def after_response():
+    """
+    Maintenance after the response is written, so the Agent does not wait for it
+    """
+    if probe_cache:
+        try:
+            probe_cache.evict()
+        except sqlite3.Error:
+            log.exception('Failed to remove old files from cache')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        filename=log_filename,
+        format='%(asctime)s - %(process)d - %(levelname)s: %(message)s',
+        level=logging.DEBUG)
+
+    data_in = None
+
+    # Check if there is incoming data on STDIN and read it
+    r_list, w_list, x_list = select.select([sys.stdin], [], [], 0)
+    log.debug('Start - r_list: %r - args: %r - os.getcwd(): %s', r_list, sys.argv, os.getcwd())
+    if r_list:
+        data_in = sys.stdin.read()
+    log.debug('Started - data in: %r', data_in)
+
+    write_status(handle_request(data_in))
+    after_response()
 
-log.debug('Done')
+    log.debug('Done')
@@ -0,0 +1,88 @@
+"""
+Shared parts of mac_agent_validation_pipeline.py and mac_agent_helper_shim.py: reading the request from
+stdin, writing the response to stdout and checking the files of a request. The other scripts do this
+themselves, so that each of them can be used alone.
+
+A script implements handle_request(data_in), and optionally after_response(), and when executed calls
+
+run(__file__, handle_request, after_response)
+
+Keep this file in the same directory as the scripts using it.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pathlib
+import select
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+log = logging.getLogger(__name__)
+
+
+def setup_logging(script_file: str) -> None:
+    """
+    Setup logging into a file in same directory as the script, .log suffix
+    """
+    logging.basicConfig(
+        filename=pathlib.Path(script_file).with_suffix(".log").resolve(),
+        format="%(asctime)s - %(process)d - %(levelname)s: %(message)s",
+        level=logging.DEBUG,
+    )
+
+
+def read_request() -> str | None:
+    """
+    Read the request from stdin (from the Agent), None if there is no incoming data
+    """
+    data_in = None
+    # Check if there is incoming data on STDIN and read it
+    r_list, w_list, x_list = select.select([sys.stdin], [], [], 0)
+    log.debug("Start - r_list: %r - args: %r - os.getcwd(): %s", r_list, sys.argv, os.getcwd())
+    if r_list:
+        data_in = sys.stdin.read()
+    log.debug("Started - data in: %r", data_in)
+    return data_in
+
+
+def write_status(data: dict) -> None:
+    """
+    Write status to stdout (to the Agent), ending in a newline character, and flush the buffer so receiver
+    can handle it.
+
+    :param data: dict, converted to JSON
+    """
+    log.debug("Writing response: %r", data)
+    json.dump(data, sys.stdout)
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+
+def check_files(request: dict, get_file_status: Callable[[dict], dict], workers: int = 1) -> dict:
+    """
+    Response with the status of each file of a request
+
+    :param get_file_status: Returns the status dict, with "path", "status" and "message", of a file in the request
+    :param workers: Number of files checked in parallel, the results are in the same order as the files
+    """
+    files = request.get("files", [])
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return {"status": "done", "files": list(executor.map(get_file_status, files))}
+    return {"status": "done", "files": [get_file_status(file_info) for file_info in files]}
+
+
+def run(
+    script_file: str, handle_request: Callable[[str | None], dict], after_response: Callable[[], None] | None = None
+) -> None:
+    """
+    Handle the request of the Agent in stdin, and write the response to stdout
+    """
+    setup_logging(script_file)
+    write_status(handle_request(read_request()))
+    if after_response:
+        after_response()
+    log.debug("Done")
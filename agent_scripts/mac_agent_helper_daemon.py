@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Resident helper process for Mac Agent, used through mac_agent_helper_shim.py.
+
+Without it the Agent starts a new Python process for every request, which sets up logging, imports
+the script and, for mac_agent_check_mediainfo.py, opens its cache. The daemon loads the script once
+and handles the requests forwarded by the shim over a Unix socket, with the same api_version 2
+protocol, so the script keeps its state, e.g. the open cache, between requests.
+
+The script is one of the agent scripts with a handle_request(data_in) function, and optionally
+after_response(). Start the daemon as the user running the Agent, e.g. from a launchd LaunchAgent:
+
+/usr/bin/env python3 mac_agent_helper_daemon.py [--script mac_agent_check_mediainfo]
+
+and set mac_agent_helper_shim.py as the Helper App in Agent Preferences. The shim handles the requests
+itself with the script set in the CANTEMO_AGENT_HELPER_SCRIPT environment variable, which is also the
+default --script, when the daemon is not running. So with another script set it in the environment of
+both the daemon and the Agent instead of using --script.
+
+To compare the time the Agent waits for a request with and without the daemon:
+
+/usr/bin/env python3 mac_agent_helper_daemon.py --benchmark 20 [--request request.json]
+"""
+from __future__ import annotations
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import pathlib
+import signal
+import socket
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Unix socket where the daemon listens
+from mac_agent_helper_shim import SOCKET_PATH, get_socket_dir_error
+
+# Script handling the requests, also used by mac_agent_helper_shim.py when the daemon is not running
+SCRIPT = os.environ.get("CANTEMO_AGENT_HELPER_SCRIPT", "mac_agent_check_mediainfo")
+
+log = logging.getLogger(__name__)
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        # The shim sends what it read from stdin, then closes its side
+        data_in = self.rfile.read().decode() or None
+        log.debug("Request: %r", data_in)
+        script = self.server.script
+        try:
+            response = script.handle_request(data_in)
+        except Exception:
+            log.exception("Failed to handle request")
+            # Do not accept or decline any files
+            response = {}
+        log.debug("Writing response: %r", response)
+        try:
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+            # The shim, and the Agent, are done
+            self.connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            # E.g. is_running() of another daemon or benchmark, which does not wait for the response
+            log.debug("Client closed the connection")
+            return
+        if hasattr(script, "after_response"):
+            script.after_response()
+
+
+class AgentHelperDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, script) -> None:
+        self.script = script
+        # Only the user running the Agent can connect
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, AgentRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+
+def is_running(socket_path: str) -> bool:
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        client.close()
+
+
+def time_command(command: list[str], request_path: str, env: dict, runs: int) -> float:
+    """
+    Median time in milliseconds to run a command with the request in stdin.
+    """
+    times = []
+    for _ in range(runs):
+        # A file, so the request is readable when the script checks stdin
+        with open(request_path, "rb") as request_input:
+            start = time.perf_counter()
+            subprocess.run(command, stdin=request_input, stdout=subprocess.DEVNULL, env=env, check=True)
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def benchmark(script_name: str, runs: int, request_path: str | None) -> None:
+    basedir = pathlib.Path(__file__).resolve().parent
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if request_path is None:
+            # Empty request, the Agent checking the api_version
+            request_path = os.path.join(tmpdir, "request.json")
+            open(request_path, "w").close()
+        socket_path = os.path.join(tmpdir, "helper.sock")
+        env = dict(os.environ, CANTEMO_AGENT_HELPER_SOCKET=socket_path, CANTEMO_AGENT_HELPER_SCRIPT=script_name)
+
+        script_ms = time_command([sys.executable, str(basedir / f"{script_name}.py")], request_path, env, runs)
+        print(f"{script_name}.py: {script_ms:.1f} ms")
+
+        daemon = subprocess.Popen([sys.executable, __file__, "--script", script_name], env=env)
+        try:
+            while not is_running(socket_path):
+                time.sleep(0.05)
+            shim = str(basedir / "mac_agent_helper_shim.py")
+            shim_ms = time_command([sys.executable, shim], request_path, env, runs)
+            print(f"mac_agent_helper_shim.py with daemon: {shim_ms:.1f} ms")
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Resident helper process for Mac Agent")
+    parser.add_argument("--script", default=SCRIPT, help="Script handling the requests (default %(default)s)")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Unix socket to listen on (default %(default)s)")
+    parser.add_argument("--benchmark", type=int, metavar="RUNS", help="Compare the time of the script and the shim")
+    parser.add_argument("--request", help="With --benchmark, file with the request (default empty)")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.script, args.benchmark, args.request)
+        return
+
+    # Setup logging into a file in same directory as source file, .log suffix
+    logging.basicConfig(
+        filename=pathlib.Path(__file__).with_suffix(".log").resolve(),
+        format="%(asctime)s - %(process)d - %(thread)d - %(levelname)s: %(message)s",
+        level=logging.DEBUG,
+    )
+
+    # Only this user can write to the directory, so no one else can put a socket there for the shim
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), mode=0o700, exist_ok=True)
+    socket_error = get_socket_dir_error(args.socket)
+    if socket_error:
+        parser.error(socket_error)
+    if args.script != SCRIPT:
+        log.warning("--script %s but the shim handles requests with %s without the daemon", args.script, SCRIPT)
+    if is_running(args.socket):
+        parser.error(f"A daemon is already running at {args.socket}")
+    # Left behind by a daemon which was killed
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    server = AgentHelperDaemon(args.socket, importlib.import_module(args.script))
+    # Stop cleanly, removing the socket, also when stopped by launchd or kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+    log.info("Handling requests with %s on %s", args.script, args.socket)
+    try:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        thread.join()
+    except KeyboardInterrupt:
+        server.shutdown()
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+    log.info("Stopped")
+
+
+if __name__ == "__main__":
+    main()
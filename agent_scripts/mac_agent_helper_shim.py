@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Helper App for Mac Agent which forwards the requests to mac_agent_helper_daemon.py.
+
+Set this as the Helper App in Agent Preferences, with the daemon running. It only passes stdin to the
+daemon over a Unix socket and writes the response to stdout, so it starts quickly, and the daemon
+handles the request with a script which is already loaded.
+
+If the daemon is not running, the request is handled in this process by FALLBACK_SCRIPT from the same
+directory, as if the script was set as the Helper App. It is set with the CANTEMO_AGENT_HELPER_SCRIPT
+environment variable, like the default --script of the daemon, so that the files are checked the same way
+with and without the daemon. The same is done if other users could write to the directory of the socket,
+and so could have put a socket of their own there to receive the requests.
+"""
+from __future__ import annotations
+
+import os
+import select
+import socket
+import stat
+import sys
+
+# Unix socket of mac_agent_helper_daemon.py, which imports it from here. By default in a directory of its
+# own which only the user running the Agent can write to
+SOCKET_PATH = os.environ.get(
+    "CANTEMO_AGENT_HELPER_SOCKET",
+    os.path.join(os.environ.get("TMPDIR", "/tmp"), f"cantemo_agent_helper-{os.getuid()}", "helper.sock"),
+)
+
+# Script which handles the request if the daemon is not running, the same default is in mac_agent_helper_daemon.py
+FALLBACK_SCRIPT = os.environ.get("CANTEMO_AGENT_HELPER_SCRIPT", "mac_agent_check_mediainfo")
+
+
+def get_socket_dir_error(socket_path: str) -> str | None:
+    """
+    Check that only this user can write to the directory of the socket, returns None if so or the error
+    message.
+    """
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    try:
+        dir_stat = os.lstat(socket_dir)
+    except OSError as e:
+        return f"Cannot read {socket_dir}: {e}"
+    if not stat.S_ISDIR(dir_stat.st_mode):
+        return f"{socket_dir} is not a directory"
+    if dir_stat.st_uid not in (os.getuid(), 0):
+        return f"{socket_dir} is owned by another user"
+    if dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return f"{socket_dir} is writable by other users"
+    return None
+
+
+def handle_without_daemon(data_in: bytes, socket_error: str | None = None) -> None:
+    import importlib
+    import logging
+
+    from mac_agent_common import setup_logging, write_status
+
+    script = importlib.import_module(FALLBACK_SCRIPT)
+    setup_logging(script.__file__)
+    if socket_error:
+        logging.getLogger(__name__).warning("Not using the daemon at %s: %s", SOCKET_PATH, socket_error)
+    write_status(script.handle_request(data_in.decode() or None))
+    if hasattr(script, "after_response"):
+        script.after_response()
+
+
+if __name__ == "__main__":
+    data_in = b""
+    # Check if there is incoming data on STDIN and read it
+    r_list, w_list, x_list = select.select([sys.stdin], [], [], 0)
+    if r_list:
+        data_in = sys.stdin.buffer.read()
+
+    socket_error = None
+    # The daemon creates the directory, it is missing if the daemon has never been started
+    if os.path.lexists(os.path.dirname(os.path.abspath(SOCKET_PATH))):
+        socket_error = get_socket_dir_error(SOCKET_PATH)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if socket_error:
+            raise OSError(socket_error)
+        client.connect(SOCKET_PATH)
+    except OSError:
+        client.close()
+        handle_without_daemon(data_in, socket_error)
+    else:
+        with client:
+            client.sendall(data_in)
+            # End of the request
+            client.shutdown(socket.SHUT_WR)
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                sys.stdout.buffer.write(chunk)
+        sys.stdout.flush()
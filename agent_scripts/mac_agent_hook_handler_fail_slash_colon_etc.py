@@ -68,6 +68,23 @@ def write_status(data: dict) -> None:
     sys.stdout.flush()
 
 
+def handle_request(data_in: str | None) -> dict:
+    """
+    Handle a request from the Agent
+
+    :param data_in: Data read from stdin, None if there was none
+    :return: Response dict
+    """
+    if not data_in:
+        # No input - give API level response so Agent can detect support
+        return {"api_version": 2, "app_name": "Check Mediainfo"}
+
+    # Else return status per file. We don't need to care about the
+    # input "operation" here as we only check filenames
+    request = json.loads(data_in)
+    return {"status": "done", "files": [get_file_status(file_info) for file_info in request.get("files", [])]}
+
+
 if __name__ == "__main__":
     # Setup logging into a file in same directory as source file, .log suffix
     log_filename = pathlib.Path(__file__).with_suffix(".log").resolve()
@@ -85,21 +102,6 @@ if __name__ == "__main__":
         data_in = sys.stdin.read()
     log.debug("Started - data in: %r", data_in)
 
-    if not data_in:
-        # No input - give API level response so Agent can detect support
-        write_status({"api_version": 2, "app_name": "Check Mediainfo"})
-    else:
-        # Else return status per file. We don't need to care about the
-        # input "operation" here as we only check filenames
-        request = json.loads(data_in)
-
-        files = request.get("files", [])
-        file_statuses = []
-
-        for file_info in request.get("files", []):
-            file_status = get_file_status(file_info)
-            file_statuses.append(file_status)
-
-        write_status({"status": "done", "files": file_statuses})
+    write_status(handle_request(data_in))
 
     log.debug("Done")
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Script for Mac Agent which runs a chain of checks on each file, configured in a JSON file.
+
+The checks of the other scripts are available as validators:
+- "filename_characters": only ACCEPTED_CHARACTERS in the filename, from
+  mac_agent_hook_handler_fail_slash_colon_etc.py
+- "no_upper_case": no upper case characters in the filename, as mac_agent_hook_handler_fail_upper_case.py
+- "mediainfo_resolution": Full HD and not vertical video, from mac_agent_check_mediainfo.py, which must
+  be in the same directory, with mediainfo installed
+
+The validators are run in the order of the configuration, and the first one which fails a file decides
+its message, the rest are not run on it. List the cheap filename checks first, so that mediainfo is
+only run on files with valid names. The configuration is read from CONFIG_FILENAME on each request,
+see mac_agent_validation_pipeline_example.json:
+
+{"operations": ["file_ready"], "validators": ["filename_characters", "mediainfo_resolution"]}
+
+Files are only checked on the listed operations, other requests do not accept or decline any files.
+Without a configuration file DEFAULT_CONFIG is used.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pathlib
+
+import mac_agent_check_mediainfo
+from mac_agent_common import check_files, run
+from mac_agent_hook_handler_fail_slash_colon_etc import get_filename_error
+
+CONFIG_FILENAME = pathlib.Path(__file__).with_name("mac_agent_validation_pipeline.json")
+
+DEFAULT_CONFIG = {"operations": ["file_ready"], "validators": ["filename_characters", "mediainfo_resolution"]}
+
+log = logging.getLogger(__name__)
+
+
+def check_filename_characters(path: str) -> tuple[str, str]:
+    error = get_filename_error(os.path.basename(path))
+    if error:
+        return "failed", error
+    return "ok", "Filename OK"
+
+
+def check_no_upper_case(path: str) -> tuple[str, str]:
+    if any(char.isupper() for char in os.path.basename(path)):
+        return "failed", "Filename must not contain upper case"
+    return "ok", "Filename OK"
+
+
+def check_mediainfo_resolution(path: str) -> tuple[str, str]:
+    file_status = mac_agent_check_mediainfo.check_file({"path": path})
+    return file_status["status"], file_status["message"]
+
+
+# Validators by name, each returns (status, message) for a file path, status "ok" or "failed"
+VALIDATORS = {
+    "filename_characters": check_filename_characters,
+    "no_upper_case": check_no_upper_case,
+    "mediainfo_resolution": check_mediainfo_resolution,
+}
+
+
+def load_config() -> dict:
+    """
+    Read the configuration from CONFIG_FILENAME, DEFAULT_CONFIG if it does not exist
+
+    Raises ValueError if the configuration is invalid
+    """
+    if not CONFIG_FILENAME.exists():
+        return DEFAULT_CONFIG
+    with open(CONFIG_FILENAME) as config_file:
+        config = json.load(config_file)
+    if not isinstance(config, dict):
+        raise ValueError(f"Invalid configuration in {CONFIG_FILENAME}, not an object: {config!r}")
+    operations = config.get("operations", DEFAULT_CONFIG["operations"])
+    # A list, e.g. a string would match any part of it in the operation
+    if not isinstance(operations, list) or not all(isinstance(operation, str) for operation in operations):
+        raise ValueError(f"Invalid operations {operations!r} in {CONFIG_FILENAME}, not a list of names")
+    validators = config.get("validators")
+    if not isinstance(validators, list) or not validators:
+        raise ValueError(f"Invalid validators {validators!r} in {CONFIG_FILENAME}, not a list of names")
+    unknown = [name for name in validators if not isinstance(name, str) or name not in VALIDATORS]
+    if unknown:
+        raise ValueError(f"Invalid validators {validators} in {CONFIG_FILENAME}, unknown: {unknown}")
+    return {"operations": operations, "validators": validators}
+
+
+def get_file_status(file_info: dict, validators: list[str]) -> dict:
+    messages = []
+    for name in validators:
+        status, message = VALIDATORS[name](file_info["path"])
+        log.debug("%s: %s %s: %s", file_info["path"], name, status, message)
+        if status != "ok":
+            # The first failure decides, the more expensive checks after it are not run
+            return {"path": file_info["path"], "status": status, "message": message}
+        messages.append(message)
+    # Each different message once, e.g. "Filename OK" of two filename checks
+    return {"path": file_info["path"], "status": "ok", "message": ", ".join(dict.fromkeys(messages))}
+
+
+def handle_request(data_in: str | None) -> dict:
+    """
+    Handle a request from the Agent
+
+    :param data_in: Data read from stdin, None if there was none
+    :return: Response dict
+    """
+    if not data_in:
+        # No input - give API level response so Agent can detect support
+        return {"api_version": 2, "app_name": "Validation Pipeline"}
+
+    try:
+        config = load_config()
+    except (OSError, ValueError):
+        # Do not accept or decline any files with a broken configuration
+        log.exception("Failed to read configuration")
+        return {}
+
+    request = json.loads(data_in)
+    if request.get("operation") not in config["operations"]:
+        # Do not accept or decline any files, e.g. not "approve" on file_new before the checks on file_ready
+        return {}
+
+    if "mediainfo_resolution" in config["validators"]:
+        mac_agent_check_mediainfo.get_probe_cache()
+    # The files are checked in parallel for the mediainfo probes, results in the same order as the files
+    return check_files(
+        request,
+        lambda file_info: get_file_status(file_info, config["validators"]),
+        mac_agent_check_mediainfo.MEDIAINFO_WORKERS,
+    )
+
+
+def after_response() -> None:
+    """
+    Maintenance after the response is written, so the Agent does not wait for it
+    """
+    mac_agent_check_mediainfo.after_response()
+
+
+if __name__ == "__main__":
+    run(__file__, handle_request, after_response)
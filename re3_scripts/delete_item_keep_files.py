@@ -34,38 +34,204 @@ delete anything. This is useful for local testing. Note that as a Rules Engine 3
 expects a item ID in the "portal_itemId" environment variable, run like this from the commandline:
 
 portal_itemId=VX-1979 /opt/cantemo/portal/portal/plugins/rulesengine3/shellscripts/delete_item_keep_files.py
-"""
 
-import os
-import sys
+Many items can be deleted in one run, with --workers concurrent requests, from a file with one item ID
+per line (- for standard input), or from the library of a Portal saved search:
 
-import django
+delete_item_keep_files.py --itemsFile=items.txt --workers=8
+delete_item_keep_files.py --library=VX-12 --dryrun
 
-sys.path.append("/opt/cantemo/portal")
-os.environ["DJANGO_SETTINGS_MODULE"] = "portal.settings"
+The result for every item is printed, and the script exits with status 1 if any delete failed.
 
-django.setup()
-# Now Cantemo/Django environment is setup and helper classes are available
+To see what would be deleted before deleting, --plan lists the files of the items, with the shapes
+and files of SHAPE_SEARCH_BATCH items read in one request, and prints for each storage how many files
+and bytes would be kept and deleted. Nothing is deleted. --planFile writes every file to a CSV file:
+
+delete_item_keep_files.py --library=VX-12 --keepShapeTagMedia=original --plan --planFile=plan.csv
+
+Requires portal_bootstrap.py in the same directory. The Cantemo/Django environment is only set up
+when deleting, --dryrun without --library does not need it. If portal_worker.py is running, the
+deletes are sent to it instead, except with --library or --dryrun.
+"""
 
 import argparse
+import csv
 import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlencode
+
+from portal_bootstrap import (
+    WorkerUnavailable,
+    call_worker,
+    create_session,
+    get_library_item_ids,
+    get_vidispine_url,
+    read_item_ids,
+    setup_portal,
+)
 
 # Logging through standard Cantemo logging, i.e. to /var/log/cantemo/portal/portal.log
 log = logging.getLogger("portal.plugins.rulesengine3.shellscripts")
 
 
+# Items whose shapes are read in one search request with --plan
+SHAPE_SEARCH_BATCH = 100
+
+# Components of a shape which have files
+FILE_COMPONENTS = ["containerComponent", "videoComponent", "audioComponent", "binaryComponent", "descriptorComponent"]
+
+# Lines are printed from the delete workers
+print_lock = threading.Lock()
+
+
 def print_and_log(text):
-    print(text)
+    with print_lock:
+        print(text)
     log.info(text)
 
 
-def delete_item(item_id, args):
+def connect_vidispine():
+    """
+    Setup the Cantemo/Django environment, return the Vidispine URL and a HTTP session to it.
+    """
+    setup_portal()
     # Import only when successfully trying to delete
     from portal.vidispine.iitem import ItemHelper
-    from RestAPIBase.resturl import RestURL
-    from RestAPIBase.utility import prepare_request
-    from RestAPIBase.utility import perform_request
 
+    # No runas-parameter, runs as admin. One helper and HTTP session shared by all requests.
+    item_helper = ItemHelper()
+    return item_helper.itemapi.vsapi.super_url, create_session(item_helper)
+
+
+def get_items_shapes(session, vs_url, item_ids):
+    """
+    Get the shapes of at most SHAPE_SEARCH_BATCH items with one search request, as {item ID: [shape, ...]}.
+    Items which do not exist are left out.
+    """
+    search_document = {"field": [{"name": "itemId", "value": [{"value": item_id} for item_id in item_ids]}]}
+    # Vidispine reads the paging of a search from matrix parameters, query parameters are ignored
+    response = session.put(
+        f"{vs_url}API/item;first=1;number={len(item_ids)}", params={"content": "shape"}, json=search_document
+    )
+    response.raise_for_status()
+    return {item["id"]: item.get("shape", []) for item in response.json().get("item", [])}
+
+
+def get_shape_files(shape):
+    """
+    Get the files of all components of a shape, each once.
+    """
+    files = {}
+    for component_name in FILE_COMPONENTS:
+        components = shape.get(component_name, [])
+        # containerComponent is a single component, the others lists
+        if isinstance(components, dict):
+            components = [components]
+        for component in components:
+            for file in component.get("file", []):
+                files.setdefault(file["id"], file)
+    return list(files.values())
+
+
+def parse_keep_values(value):
+    """
+    Set of the comma separated values of a --keep* argument, None if everything is kept.
+    """
+    if value is None or value == "*":
+        return None
+    return set(value.split(","))
+
+
+def plan_items(item_ids, args, vs_url, session):
+    """
+    List the files of the items, and if they would be kept or deleted with the --keep* arguments.
+
+    :return: Rows of (item ID, shape ID, shape tags, storage, file ID, path, size in bytes, "keep" or "delete"),
+        and the IDs of the items which were not found
+    """
+    keep_tags = parse_keep_values(args.keepShapeTagMedia)
+    keep_storages = parse_keep_values(args.keepShapeTagStorage)
+    batches = [item_ids[i : i + SHAPE_SEARCH_BATCH] for i in range(0, len(item_ids), SHAPE_SEARCH_BATCH)]
+
+    rows = []
+    missing = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for batch, items_shapes in zip(
+            batches, executor.map(lambda batch: get_items_shapes(session, vs_url, batch), batches)
+        ):
+            missing.extend(item_id for item_id in batch if item_id not in items_shapes)
+            for item_id, shapes in items_shapes.items():
+                for shape in shapes:
+                    tags = shape.get("tag", [])
+                    tag_kept = keep_tags is None or not keep_tags.isdisjoint(tags)
+                    for file in get_shape_files(shape):
+                        storage = file.get("storage", "")
+                        # Only files that match both the shape tags and the storages are kept
+                        kept = tag_kept and (keep_storages is None or storage in keep_storages)
+                        # Size is -1 when not known
+                        size = max(int(file.get("size", 0)), 0)
+                        rows.append(
+                            (
+                                item_id,
+                                shape["id"],
+                                ",".join(tags),
+                                storage,
+                                file["id"],
+                                file.get("path", ""),
+                                size,
+                                "keep" if kept else "delete",
+                            )
+                        )
+    return rows, missing
+
+
+def print_plan(rows, missing, plan_file=None):
+    """
+    Print the number of files and bytes kept and deleted per storage, and write all rows to plan_file.
+    """
+    # A file can be in many shapes, it is kept if any of its shapes keeps it
+    actions = {}
+    for item_id, shape_id, tags, storage, file_id, path, size, action in rows:
+        if actions.get(file_id) != "keep":
+            actions[file_id] = action
+    rows = [row[:-1] + (actions[row[4]],) for row in rows]
+
+    if plan_file:
+        with open(plan_file, "w", newline="") as plan_output:
+            writer = csv.writer(plan_output)
+            writer.writerow(["item", "shape", "tags", "storage", "file", "path", "bytes", "action"])
+            writer.writerows(rows)
+        print_and_log(f"Wrote {len(rows)} files to {plan_file}")
+
+    # Each file is counted once
+    totals = {}
+    counted = set()
+    for item_id, shape_id, tags, storage, file_id, path, size, action in rows:
+        if file_id in counted:
+            continue
+        counted.add(file_id)
+        storage_totals = totals.setdefault(storage, {"keep": [0, 0], "delete": [0, 0]})
+        storage_totals[action][0] += 1
+        storage_totals[action][1] += size
+
+    print_and_log(f"{'Storage':<12} {'Keep files':>10} {'Keep GB':>10} {'Delete files':>12} {'Delete GB':>10}")
+    for storage in sorted(totals):
+        keep_files, keep_bytes = totals[storage]["keep"]
+        delete_files, delete_bytes = totals[storage]["delete"]
+        print_and_log(
+            f"{storage:<12} {keep_files:>10} {keep_bytes / 1e9:>10.2f} {delete_files:>12} {delete_bytes / 1e9:>10.2f}"
+        )
+    deleted_bytes = sum(storage_totals["delete"][1] for storage_totals in totals.values())
+    print_and_log(f"Total {deleted_bytes} bytes would be freed from {len(counted)} files")
+    if missing:
+        print_and_log(f"{len(missing)} items not found: {', '.join(missing[:10])}")
+
+
+def delete_item(item_id, args, vs_url, session):
     if args.keepShapeTagMedia is None and args.keepShapeTagStorage is None:
         # Both arguments undefined -> default to * = keep every file
         args.keepShapeTagMedia = args.keepShapeTagStorage = "*"
@@ -79,24 +245,79 @@ def delete_item(item_id, args):
 
     print_and_log(f"Deleting item {item_id}, keeping files, query values: {query}")
 
-    # No runas-parameter, runs as admin.
-    item_helper = ItemHelper()
-
     # ItemHelper removeItem() function does not currently support additional parameters, so we
     # create the URL and request here.
-    rest_url = RestURL(f"{item_helper.itemapi.vsapi.super_url}API/item/{item_id}")
-    rest_url.addQuery(query)
-    param_dict = prepare_request(item_helper.itemapi.vsapi.base64string, rest_url.geturl(), method="DELETE")
+    url = f"{vs_url}API/item/{item_id}?{urlencode(query)}"
 
     if args.dryrun:
-        print_and_log(f"Dry-run: Would do DELETE request to {rest_url.geturl()}")
+        print_and_log(f"Dry-run: Would do DELETE request to {url}")
     else:
-        print_and_log(f"Performing DELETE request to {rest_url.geturl()}")
-        # This raises on any HTTP error - let that exit the script.
-        perform_request(**param_dict)
+        print_and_log(f"Performing DELETE request to {url}")
+        # This raises on any HTTP error
+        session.delete(url).raise_for_status()
         print_and_log(f"DELETE success.")
 
 
+def delete_item_with_worker(item_id, args):
+    call_worker(
+        "delete_item_keep_files",
+        item_id=item_id,
+        keepShapeTagMedia=args.keepShapeTagMedia,
+        keepShapeTagStorage=args.keepShapeTagStorage,
+    )
+
+
+def worker_is_running():
+    try:
+        call_worker("ping", timeout=5)
+        return True
+    except WorkerUnavailable:
+        return False
+
+
+def delete_items(item_ids, args):
+    """
+    Delete items with args.workers concurrent requests, print the result of each item.
+
+    :return: Number of items that failed
+    """
+    if not args.dryrun and not args.library and worker_is_running():
+        # portal_worker.py has the Django environment and a Vidispine session ready
+        print_and_log("Sending the deletes to portal_worker.py")
+        delete = partial(delete_item_with_worker, args=args)
+    else:
+        if args.dryrun and not args.library:
+            # Nothing is requested from Vidispine, only the URL is needed
+            vs_url = get_vidispine_url()
+            session = None
+        else:
+            vs_url, session = connect_vidispine()
+        delete = partial(delete_item, args=args, vs_url=vs_url, session=session)
+
+    if args.library:
+        item_ids = item_ids + get_library_item_ids(session, vs_url, args.library)
+    print_and_log(f"Deleting {len(item_ids)} items with {args.workers} workers")
+
+    def delete_and_report(item_id):
+        try:
+            delete(item_id)
+            return item_id, None
+        except Exception as e:
+            log.exception("Failed to delete item %s", item_id)
+            return item_id, str(e)
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for item_id, error in executor.map(delete_and_report, item_ids):
+            if error:
+                failed += 1
+                print_and_log(f"{item_id}: FAILED: {error}")
+            else:
+                print_and_log(f"{item_id}: OK")
+    print_and_log(f"Done: {len(item_ids) - failed} items OK, {failed} failed")
+    return failed
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter
@@ -114,15 +335,40 @@ def main():
         help="Comma separated list of storages on which to keep files (default is keep all shapes on all storages)",
     )
     parser.add_argument("--dryrun", action="store_true")
+    parser.add_argument("--itemsFile", help="File with one item ID per line to delete, - for standard input")
+    parser.add_argument("--library", help="Delete the items in this library, e.g. of a saved search")
+    parser.add_argument("--workers", type=int, default=4, help="Number of concurrent requests (default 4)")
+    parser.add_argument("--plan", action="store_true", help="Only print what would be kept and deleted")
+    parser.add_argument("--planFile", help="With --plan, write every file of the items to this CSV file")
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be 1 or more")
+    if args.planFile and not args.plan:
+        parser.error("--planFile requires --plan")
     if args.dryrun:
         print_and_log("--dryrun defined, will not do any requests to delete item.")
 
-    item_id = os.environ.get("portal_itemId")
-    if item_id:
-        delete_item(item_id, args)
+    item_ids = []
+    if os.environ.get("portal_itemId"):
+        item_ids.append(os.environ["portal_itemId"])
+    if args.itemsFile:
+        item_ids.extend(read_item_ids(args.itemsFile))
+
+    if (item_ids or args.library) and args.plan:
+        vs_url, session = connect_vidispine()
+        if args.library:
+            item_ids = item_ids + get_library_item_ids(session, vs_url, args.library)
+        print_and_log(f"Planning delete of {len(item_ids)} items")
+        rows, missing = plan_items(item_ids, args, vs_url, session)
+        print_plan(rows, missing, args.planFile)
+    elif item_ids or args.library:
+        if delete_items(item_ids, args):
+            sys.exit(1)
     else:
-        print_and_log("portal_itemId env variable not set, quitting. See --help for usage example")
+        print_and_log(
+            "portal_itemId env variable, --itemsFile or --library not set, quitting. See --help for usage example"
+        )
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/opt/cantemo/python/bin/python
+"""
+Lightweight Cantemo/Django environment setup and Vidispine helpers shared by the Rules Engine 3 scripts.
+
+Setting up Django takes seconds, so the scripts only call setup_portal() when they actually need the
+Portal API. Paths like --help, or a missing portal_itemId, exit without it.
+
+Upload this file in Admin > Rules Engine 3 together with the scripts that use it. Executed as such it
+runs a startup time benchmark of the scripts:
+
+/opt/cantemo/python/bin/python portal_bootstrap.py [script.py ...]
+"""
+import configparser
+import json
+import os
+import socket
+import stat
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PORTAL_PATH = "/opt/cantemo/portal"
+PORTAL_CONFIG = "/etc/cantemo/portal/portal.conf"
+
+# Unix socket of portal_worker.py, the scripts send their items to it when it is running. By default in a
+# directory of its own which only the user running the scripts can write to, so another user cannot put a
+# socket there to receive the items
+WORKER_SOCKET = os.environ.get(
+    "RE3_WORKER_SOCKET", os.path.join(tempfile.gettempdir(), f"re3_portal_worker-{os.getuid()}", "worker.sock")
+)
+
+_portal_setup_done = False
+
+
+class WorkerUnavailable(Exception):
+    """
+    portal_worker.py is not running.
+    """
+
+
+class WorkerError(Exception):
+    """
+    portal_worker.py failed to handle a request.
+    """
+
+
+def setup_portal():
+    """
+    Setup the Cantemo/Django environment, so helper classes like ItemHelper and the standard Cantemo
+    logging are available. Only the first call does anything.
+    """
+    global _portal_setup_done
+    if _portal_setup_done:
+        return
+    sys.path.append(PORTAL_PATH)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+
+    import django
+
+    django.setup()
+    _portal_setup_done = True
+
+
+def get_vidispine_url():
+    """
+    Vidispine URL from the Portal configuration file, e.g. "http://localhost:8080/", without setting up Django.
+    """
+    config = configparser.ConfigParser()
+    config.read(PORTAL_CONFIG)
+    return f'{config.get("vidispine", "VIDISPINE_URL")}:{config.get("vidispine", "VIDISPINE_PORT")}/'
+
+
+def create_session(item_helper):
+    """
+    Create a HTTP session to Vidispine, with the credentials of item_helper, shared by all requests.
+    """
+    import requests
+
+    session = requests.Session()
+    session.headers["Authorization"] = f"Basic {item_helper.itemapi.vsapi.base64string.strip()}"
+    session.headers["Accept"] = "application/json"
+    return session
+
+
+def get_library_item_ids(session, vs_url, library_id):
+    """
+    Get the IDs of all items in a Vidispine library, e.g. the library of a Portal saved search.
+    """
+    item_ids = []
+    number = 1000
+    while True:
+        response = session.get(
+            f"{vs_url}API/library/{library_id}", params={"first": len(item_ids) + 1, "number": number}
+        )
+        response.raise_for_status()
+        page = response.json().get("uri", [])
+        item_ids.extend(page)
+        if len(page) < number:
+            return item_ids
+
+
+def read_item_ids(filename):
+    """
+    Read item IDs from a file, one per line. "-" reads standard input.
+    """
+    if filename == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(filename) as items_file:
+            lines = items_file.read().splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def get_worker_socket_dir_error(socket_path):
+    """
+    Check that only this user can write to the directory of the worker socket, returns None if so or
+    the error message.
+    """
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    try:
+        dir_stat = os.lstat(socket_dir)
+    except OSError as e:
+        return f"Cannot read {socket_dir}: {e}"
+    if not stat.S_ISDIR(dir_stat.st_mode):
+        return f"{socket_dir} is not a directory"
+    if dir_stat.st_uid not in (os.getuid(), 0):
+        return f"{socket_dir} is owned by another user"
+    if dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return f"{socket_dir} is writable by other users"
+    return None
+
+
+def create_worker_socket_dir(socket_path):
+    """
+    Create the directory of the worker socket, only accessible by this user, if it does not exist.
+
+    Raises ValueError if other users can write to the directory.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), mode=0o700, exist_ok=True)
+    error = get_worker_socket_dir_error(socket_path)
+    if error:
+        raise ValueError(error)
+
+
+def call_worker(command, timeout=600, **params):
+    """
+    Send a command to portal_worker.py and return its result.
+
+    Raises WorkerUnavailable if the worker is not running, or cannot be connected to, and WorkerError if
+    the command failed.
+    """
+    error = get_worker_socket_dir_error(WORKER_SOCKET)
+    if error:
+        raise WorkerUnavailable(f"Not using a worker at {WORKER_SOCKET}: {error}")
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(WORKER_SOCKET)
+    except OSError as e:
+        # Also e.g. a worker of another user (PermissionError) or one which does not accept (socket.timeout)
+        client.close()
+        raise WorkerUnavailable(f"No worker at {WORKER_SOCKET}: {e}")
+
+    with client, client.makefile("rwb") as connection:
+        connection.write(json.dumps(dict(params, command=command)).encode() + b"\n")
+        connection.flush()
+        response = connection.readline()
+    if not response:
+        raise WorkerError("Worker closed the connection")
+    response = json.loads(response)
+    if "error" in response:
+        raise WorkerError(response["error"])
+    return response["result"]
+
+
+def time_command(command, env=None, runs=5):
+    """
+    Median time in milliseconds to run a command.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    basedir = os.path.dirname(os.path.abspath(__file__))
+    scripts = sys.argv[1:] or [
+        os.path.join(basedir, name) for name in ("delete_item_keep_files.py", "recreate_thumbnails.py")
+    ]
+    env = {key: value for key, value in os.environ.items() if key != "portal_itemId"}
+
+    print(f"Python startup: {time_command([sys.executable, '-c', 'pass']):.0f} ms")
+    print(f"Django setup: {time_command([sys.executable, __file__, '--setup-only']):.0f} ms")
+    for script in scripts:
+        name = os.path.basename(script)
+        print(f"{name} --help: {time_command([sys.executable, script, '--help'], env):.0f} ms")
+        print(f"{name} without portal_itemId: {time_command([sys.executable, script], env):.0f} ms")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--setup-only"]:
+        setup_portal()
+    else:
+        main()
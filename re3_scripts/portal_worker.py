@@ -0,0 +1,156 @@
+#!/opt/cantemo/python/bin/python
+"""
+Long-running worker for the Rules Engine 3 scripts recreate_thumbnails.py and delete_item_keep_files.py.
+
+Without the worker every Rules Engine 3 trigger starts a new Python process, which sets up the
+Cantemo/Django environment and an ItemHelper before handling its one item. The worker does that once,
+and listens on a Unix socket. When it is running the scripts only send their item ID to it, and when it
+is not running they do the work themselves as before.
+
+Start it on the Portal server as the same user the Rules Engine 3 scripts run as, from a directory with
+the scripts and portal_bootstrap.py, for example from a systemd service:
+
+/opt/cantemo/python/bin/python portal_worker.py [--socket /run/portal/re3_worker.sock]
+
+The socket path can also be set with the RE3_WORKER_SOCKET environment variable, for both the worker
+and the scripts. By default it is in /tmp/re3_portal_worker-<uid>/, which is created only accessible by
+the user. The scripts do not use a socket in a directory which other users can write to. Requests are JSON objects, one per line, e.g. {"command": "recreate_thumbnails",
+"item_id": "VX-1"}, each answered with {"result": ...} or {"error": "..."}.
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import socketserver
+import threading
+import time
+
+import portal_bootstrap
+from portal_bootstrap import WorkerUnavailable, call_worker, create_session, create_worker_socket_dir, setup_portal
+
+log = logging.getLogger("portal.plugins.rulesengine3.shellscripts.portal_worker")
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # A client can send many requests on one connection
+        for line in self.rfile:
+            try:
+                response = {"result": self.server.handle_command(json.loads(line))}
+            except Exception as e:
+                log.exception("Request failed: %s", line)
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class PortalWorker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Handles the requests of the scripts, each connection in its own thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        # The scripts set up Django themselves only when run without the worker
+        import delete_item_keep_files
+        import recreate_thumbnails
+        from portal.vidispine.iitem import ItemHelper
+
+        self.delete_item_keep_files = delete_item_keep_files
+        self.recreate_thumbnails = recreate_thumbnails
+        self.item_helper = ItemHelper()  # Note: Runs as admin
+        # ItemHelper is not known to be thread safe, so the thumbnail requests use it one at a time
+        self.item_helper_lock = threading.Lock()
+        self.vs_url = self.item_helper.itemapi.vsapi.super_url
+        self.session = create_session(self.item_helper)
+        self.started = time.time()
+        self.handled = 0
+        self.commands = {
+            "ping": self.ping,
+            "recreate_thumbnails": self.recreate_thumbnails_command,
+            "delete_item_keep_files": self.delete_item_keep_files_command,
+        }
+
+        # Only the user running the worker, and the scripts, can send it requests
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def handle_command(self, request):
+        command = self.commands.get(request.get("command"))
+        if command is None:
+            raise ValueError(f"Unknown command: {request.get('command')}")
+        result = command(request)
+        self.handled += 1
+        return result
+
+    def ping(self, request):
+        return {"pid": os.getpid(), "uptime": time.time() - self.started, "handled": self.handled}
+
+    def recreate_thumbnails_command(self, request):
+        current_check = None
+        if request.get("skipCurrent"):
+            current_check = self.recreate_thumbnails.CurrentThumbnailsCheck(
+                self.session, self.vs_url, request["skipCurrent"], request.get("hashFile")
+            )
+        with self.item_helper_lock:
+            message = self.recreate_thumbnails.recreate_thumbnails(
+                self.item_helper, request["item_id"], current_check
+            )
+        log.info(message)
+        return message
+
+    def delete_item_keep_files_command(self, request):
+        args = argparse.Namespace(
+            keepShapeTagMedia=request.get("keepShapeTagMedia"),
+            keepShapeTagStorage=request.get("keepShapeTagStorage"),
+            dryrun=bool(request.get("dryrun")),
+        )
+        self.delete_item_keep_files.delete_item(request["item_id"], args, self.vs_url, self.session)
+        return f"Deleted item {request['item_id']}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-running worker for the Rules Engine 3 scripts")
+    parser.add_argument(
+        "--socket", default=portal_bootstrap.WORKER_SOCKET, help="Unix socket to listen on (default %(default)s)"
+    )
+    args = parser.parse_args()
+    portal_bootstrap.WORKER_SOCKET = args.socket
+
+    try:
+        call_worker("ping", timeout=5)
+        parser.error(f"A worker is already running at {args.socket}")
+    except WorkerUnavailable:
+        pass
+    try:
+        create_worker_socket_dir(args.socket)
+    except (OSError, ValueError) as e:
+        parser.error(f"Cannot use socket {args.socket}: {e}")
+    # Left behind by a worker which was killed
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    setup_portal()
+    server = PortalWorker(args.socket)
+    # Stop cleanly, removing the socket, also when stopped by systemd or kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+    log.info("Rules Engine 3 worker listening on %s", args.socket)
+    print(f"Listening on {args.socket}")
+    try:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        thread.join()
+    except KeyboardInterrupt:
+        server.shutdown()
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+    log.info("Rules Engine 3 worker stopped after %s requests", server.handled)
+
+
+if __name__ == "__main__":
+    main()
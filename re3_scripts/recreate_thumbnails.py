@@ -13,30 +13,392 @@ The script outputs to /var/log/cantemo/portal.log, a successful run outputs for
 2017-11-08T08:27:11.296574+00:00 centos6-portal32 portal: portal.plugins.rulesengine3.shellscripts.recreate_thumbnails
  - MainProcess[8710] - INFO - Started job: {'status': 'READY', 'started': '2017-11-08T08:27:10.021+0000',
  'jobId': 'VX-3', 'priority': 'MEDIUM', 'user': 'admin', 'type': 'THUMBNAIL'} on item VX-2
+
+Requires portal_bootstrap.py, uploaded in Rules Engine 3 the same way. If portal_worker.py is running,
+the item is sent to it instead of setting up Portal in this process.
+
+Bulk mode, from the command line on the Portal server, recreates the thumbnails of all video and
+image items in a collection, a saved search library or a file of item IDs:
+
+/opt/cantemo/python/bin/python recreate_thumbnails.py --collection VX-5 --maxJobs 20
+/opt/cantemo/python/bin/python recreate_thumbnails.py --library VX-12
+/opt/cantemo/python/bin/python recreate_thumbnails.py --itemsFile items.txt
+
+The media types are read from the search results, SEARCH_BATCH items per request. Jobs are started
+while fewer than --maxJobs THUMBNAIL jobs are running or waiting in Vidispine, counting also jobs
+started by others, and the running jobs are listed with one request every --pollInterval seconds.
+
+With --skipCurrent, in both modes, a job is only started if the thumbnails are not current:
+- --skipCurrent timestamp: the thumbnails were set before the original shape was created
+- --skipCurrent hash --hashFile thumbnails.db: the hash of the original file differs from the one
+  saved in hashFile when the thumbnails were last recreated by this script
+
+The hash is saved only in bulk mode, once the THUMBNAIL job has FINISHED. A single item run does not
+wait for its job, so it can skip items by the saved hashes but does not save new ones.
 """
-# Add Portal classes to path and setup Django environment.
-import sys
+import argparse
 import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from itertools import chain
+
+from portal_bootstrap import (
+    WorkerError,
+    WorkerUnavailable,
+    call_worker,
+    create_session,
+    get_library_item_ids,
+    read_item_ids,
+    setup_portal,
+)
+
+THUMBNAIL_MEDIA_TYPES = ['video', 'image']
+
+# Items read from Vidispine search at a time in bulk mode
+SEARCH_BATCH = 100
+
+# Vidispine job states of jobs which are not finished, failed or aborted
+ACTIVE_JOB_STATES = [
+    'NONE',
+    'READY',
+    'STARTED',
+    'STARTED_ASYNCHRONOUS',
+    'STARTED_PARALLEL',
+    'STARTED_PARALLEL_ASYNCHRONOUS',
+    'STARTED_SUBTASKS',
+    'WAITING',
+    'FAILED_RETRY',
+    'ABORTED_PENDING',
+]
+
+
+def parse_timestamp(timestamp):
+    """
+    Parse a Vidispine timestamp, e.g. 2017-11-08T08:27:10.021+0000
+    """
+    for timestamp_format in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z'):
+        try:
+            return datetime.strptime(timestamp, timestamp_format)
+        except ValueError:
+            pass
+    raise ValueError(f'Invalid timestamp: {timestamp}')
+
+
+class CurrentThumbnailsCheck:
+    """
+    Tells if the thumbnails of an item are current, so recreating them can be skipped.
+
+    The mode "timestamp" compares the time the representative thumbnail was set to the creation time of
+    the original shape. The mode "hash" compares the hash of the original file to the one saved in
+    hash_file when the thumbnails were last recreated.
+    """
+
+    def __init__(self, session, vs_url, mode, hash_file=None):
+        self.session = session
+        self.vs_url = vs_url
+        self.mode = mode
+        self.db = None
+        if mode == 'hash':
+            self.db = sqlite3.connect(hash_file)
+            self.db.execute('CREATE TABLE IF NOT EXISTS original_hash (item_id TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+            self.db.commit()
+
+    def get_original_and_thumbnail(self, item_id):
+        """
+        Returns the original shape, and the representative thumbnail metadata field, None if missing.
+        """
+        response = self.session.get(
+            f'{self.vs_url}API/item/{item_id}',
+            params={'content': 'shape,metadata', 'tag': 'original', 'field': 'representativeThumbnailNoAuth'},
+        )
+        response.raise_for_status()
+        item = response.json()
+        original = next((shape for shape in item.get('shape', []) if 'original' in shape.get('tag', [])), None)
+        thumbnail = None
+        for timespan in item.get('metadata', {}).get('timespan', []):
+            for field in timespan.get('field', []):
+                if field['name'] == 'representativeThumbnailNoAuth' and field.get('value'):
+                    thumbnail = field
+        return original, thumbnail
+
+    def check(self, item_id):
+        """
+        Returns (True if the thumbnails are current, hash of the original file to save()).
+        """
+        original, thumbnail = self.get_original_and_thumbnail(item_id)
+        if original is None or thumbnail is None:
+            return False, None
+        if self.mode == 'timestamp':
+            if 'created' not in original:
+                return False, None
+            thumbnail_time = thumbnail['value'][0].get('timestamp', thumbnail.get('timestamp'))
+            try:
+                return parse_timestamp(thumbnail_time) >= parse_timestamp(original['created']), None
+            except (TypeError, ValueError):
+                # Unknown timestamp format, or no timestamp, recreate the thumbnails to be sure
+                return False, None
+
+        files = original.get('containerComponent', {}).get('file', [])
+        original_hash = files[0].get('hash') if files else None
+        if original_hash is None:
+            # Not calculated yet by Vidispine
+            return False, None
+        row = self.db.execute('SELECT hash FROM original_hash WHERE item_id = ?', (item_id,)).fetchone()
+        return row is not None and row[0] == original_hash, original_hash
+
+    def save(self, item_id, original_hash):
+        """
+        Save the hash of the original file the thumbnails were recreated from.
+        """
+        if self.db is not None and original_hash is not None:
+            self.db.execute(
+                'INSERT OR REPLACE INTO original_hash (item_id, hash) VALUES (?, ?)', (item_id, original_hash)
+            )
+            self.db.commit()
+
+
+def recreate_thumbnails(ith, item_id, current_check=None):
+    """
+    Start a THUMBNAIL job on a video or image item, unless current_check tells its thumbnails are
+    current, return what was done.
+
+    The job is not waited for, so the hash of the original file is not saved to current_check.
+    """
+    item = ith.getItem(item_id)
+    if item.getMediaType() not in THUMBNAIL_MEDIA_TYPES:
+        return 'Item %s ignored due to media type: %s' % (item_id, item.getMediaType())
+    if current_check:
+        current, _ = current_check.check(item_id)
+        if current:
+            return 'Item %s skipped, thumbnails are current' % item_id
+    job_data = ith.recreateThumbnails(item_id)
+    return 'Started job: %s on item %s' % (job_data, item_id)
+
+
+def get_media_type(item):
+    for timespan in item.get('metadata', {}).get('timespan', []):
+        for field in timespan.get('field', []):
+            if field['name'] == 'mediaType' and field.get('value'):
+                return field['value'][0]['value']
+    return None
+
+
+def search_items(session, vs_url, search_document):
+    """
+    Yield (item ID, media type) of the items matching a Vidispine item search document.
+    """
+    first = 1
+    while True:
+        # Vidispine reads the paging of a search from matrix parameters, query parameters are ignored
+        response = session.put(
+            f'{vs_url}API/item;first={first};number={SEARCH_BATCH}',
+            params={'content': 'metadata', 'field': 'mediaType'},
+            json=search_document,
+        )
+        response.raise_for_status()
+        result = response.json()
+        # No "item" in the result when a search has no matches
+        items = result.get('item', [])
+        for item in items:
+            yield item['id'], get_media_type(item)
+        first += len(items)
+        if not items or first > int(result.get('hits', 0)):
+            return
+
+
+def get_items_media_types(session, vs_url, item_ids):
+    """
+    Yield (item ID, media type) of the items, searching SEARCH_BATCH IDs at a time. Items which do not
+    exist are left out.
+    """
+    for i in range(0, len(item_ids), SEARCH_BATCH):
+        batch = item_ids[i : i + SEARCH_BATCH]
+        search_document = {'field': [{'name': 'itemId', 'value': [{'value': item_id} for item_id in batch]}]}
+        yield from search_items(session, vs_url, search_document)
+
+
+def get_active_thumbnail_jobs(session, vs_url):
+    """
+    IDs of all THUMBNAIL jobs in Vidispine which have not ended.
+    """
+    job_ids = set()
+    number = 1000
+    while True:
+        response = session.get(
+            f'{vs_url}API/job',
+            params={
+                'type': 'THUMBNAIL',
+                'state': ','.join(ACTIVE_JOB_STATES),
+                'first': len(job_ids) + 1,
+                'number': number,
+            },
+        )
+        response.raise_for_status()
+        jobs = response.json().get('job', [])
+        job_ids.update(job['jobId'] for job in jobs)
+        if len(jobs) < number:
+            return job_ids
+
+
+def get_job_status(session, vs_url, job_id):
+    """
+    Status of a Vidispine job, e.g. FINISHED or FAILED_TOTAL.
+    """
+    response = session.get(f'{vs_url}API/job/{job_id}', params={'metadata': 'false'})
+    response.raise_for_status()
+    return response.json().get('status')
+
+
+def recreate_thumbnails_bulk(
+    ith, session, vs_url, items, max_jobs, poll_interval, print_and_log, current_check=None
+):
+    """
+    Start THUMBNAIL jobs on the video and image items, except the ones current_check tells are current,
+    keeping at most max_jobs THUMBNAIL jobs active in Vidispine, and wait until they have ended.
+    The hash of the original file is saved to current_check when the job of the item has FINISHED.
 
-sys.path.append("/opt/cantemo/portal")
-os.environ['DJANGO_SETTINGS_MODULE'] = 'portal.settings'
+    :return: Number of items on which a job could not be started
+    """
+    counts = {'submitted': 0, 'skipped': 0, 'ignored': 0, 'failed': 0}
+    own_jobs = set()
+    # Job ID -> (item ID, hash of the original file), saved when the job has finished
+    job_hashes = {}
+    active_jobs = get_active_thumbnail_jobs(session, vs_url)
 
-# Settings must be imported to setup logging correctly
-from portal import settings
-import logging
-# Logging through standard Portal logging, i.e. to /var/log/cantemo/portal/portal.log
-log = logging.getLogger('portal.plugins.rulesengine3.shellscripts.recreate_thumbnails')
+    def poll():
+        nonlocal active_jobs
+        time.sleep(poll_interval)
+        active_jobs = get_active_thumbnail_jobs(session, vs_url)
+        for job_id in own_jobs - active_jobs:
+            if job_id not in job_hashes:
+                continue
+            item_id, original_hash = job_hashes.pop(job_id)
+            status = get_job_status(session, vs_url, job_id)
+            if status == 'FINISHED':
+                current_check.save(item_id, original_hash)
+            else:
+                print_and_log(f'Job {job_id} on item {item_id} ended with status {status}')
+        own_jobs.intersection_update(active_jobs)
+        print_and_log(f'{counts}, {len(own_jobs)} of our jobs of {len(active_jobs)} THUMBNAIL jobs active')
+
+    for item_id, media_type in items:
+        if media_type not in THUMBNAIL_MEDIA_TYPES:
+            counts['ignored'] += 1
+            continue
+        try:
+            original_hash = None
+            if current_check:
+                current, original_hash = current_check.check(item_id)
+                if current:
+                    counts['skipped'] += 1
+                    continue
+            while len(active_jobs) >= max_jobs:
+                poll()
+            job_data = ith.recreateThumbnails(item_id)
+        except Exception as e:
+            print_and_log(f'Failed to start job on item {item_id}: {e}')
+            counts['failed'] += 1
+            continue
+        own_jobs.add(job_data['jobId'])
+        if original_hash is not None:
+            job_hashes[job_data['jobId']] = (item_id, original_hash)
+        active_jobs.add(job_data['jobId'])
+        counts['submitted'] += 1
+
+    while own_jobs:
+        poll()
+    print_and_log(f'Done: {counts}')
+    return counts['failed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recreate thumbnails of the item in portal_itemId, or in bulk')
+    parser.add_argument('--collection', help='Recreate thumbnails of the items in this collection')
+    parser.add_argument('--library', help='Recreate thumbnails of the items in this library, e.g. of a saved search')
+    parser.add_argument('--itemsFile', help='File with one item ID per line, - for standard input')
+    parser.add_argument(
+        '--maxJobs', type=int, default=10, help='Maximum number of active THUMBNAIL jobs (default %(default)s)'
+    )
+    parser.add_argument(
+        '--pollInterval', type=float, default=10, help='Seconds between job status checks (default %(default)s)'
+    )
+    parser.add_argument(
+        '--skipCurrent',
+        choices=['timestamp', 'hash'],
+        help='Skip items with current thumbnails, comparing to the original shape by timestamp or hash',
+    )
+    parser.add_argument(
+        '--hashFile', help='SQLite file where the original file hashes are saved for --skipCurrent hash'
+    )
+    args = parser.parse_args()
+    if args.maxJobs < 1 or args.pollInterval <= 0:
+        parser.error('--maxJobs and --pollInterval must be positive')
+    if args.skipCurrent == 'hash' and not args.hashFile:
+        parser.error('--skipCurrent hash requires --hashFile')
+
+    item_id = os.environ.get('portal_itemId')
+    bulk = args.collection or args.library or args.itemsFile
+    if not item_id and not bulk:
+        # Portal logging is not setup, this is shown in the Rules Engine 3 output
+        print('portal_itemId not set in environment')
+        return
+
+    if not bulk:
+        try:
+            # portal_worker.py, if running, has the Django environment ready and logs to portal.log
+            print(
+                call_worker(
+                    'recreate_thumbnails',
+                    item_id=item_id,
+                    skipCurrent=args.skipCurrent,
+                    hashFile=args.hashFile and os.path.abspath(args.hashFile),
+                )
+            )
+            return
+        except WorkerUnavailable:
+            pass
+        except WorkerError as e:
+            print('Failed on item %s: %s' % (item_id, e))
+            sys.exit(1)
+
+    # Setup Django environment only when there is an item, settings are needed to setup logging correctly
+    setup_portal()
+    import logging
+    # Logging through standard Portal logging, i.e. to /var/log/cantemo/portal/portal.log
+    log = logging.getLogger('portal.plugins.rulesengine3.shellscripts.recreate_thumbnails')
 
-item_id = os.environ.get('portal_itemId')
-if item_id:
     from portal.vidispine.iitem import ItemHelper
 
     ith = ItemHelper()  # Note: Runs as admin
-    item = ith.getItem(item_id)
-    if item.getMediaType() in ['video', 'image']:
-        job_data = ith.recreateThumbnails(item_id)
-        log.info('Started job: %s on item %s', job_data, item_id)
-    else:
-        log.info('Item %s ignored due to media type: %s', item_id, item.getMediaType())
-else:
-    log.info('portal_itemId not set in environment')
+    session = create_session(ith)
+    vs_url = ith.itemapi.vsapi.super_url
+    current_check = None
+    if args.skipCurrent:
+        current_check = CurrentThumbnailsCheck(session, vs_url, args.skipCurrent, args.hashFile)
+    if not bulk:
+        log.info(recreate_thumbnails(ith, item_id, current_check))
+        return
+
+    def print_and_log(text):
+        print(text)
+        log.info(text)
+
+    item_ids = [item_id] if item_id else []
+    if args.itemsFile:
+        item_ids.extend(read_item_ids(args.itemsFile))
+    if args.library:
+        item_ids.extend(get_library_item_ids(session, vs_url, args.library))
+    items = get_items_media_types(session, vs_url, item_ids)
+    if args.collection:
+        collection_search = {'field': [{'name': '__collection', 'value': [{'value': args.collection}]}]}
+        items = chain(search_items(session, vs_url, collection_search), items)
+    if recreate_thumbnails_bulk(
+        ith, session, vs_url, items, args.maxJobs, args.pollInterval, print_and_log, current_check
+    ):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,324 @@
+#!/opt/cantemo/python/bin/python
 # A script which calculates the total duration of Portal's items in seconds.
 #
-# Best is to execute this with portal management shell:
-#    /opt/cantemo/portal/manage.py shell < calculate_portal_total_items_duration.py
+# To be copied and executed on the Portal server, with the Portal python:
+#    /opt/cantemo/python/bin/python calculate_portal_total_items_duration.py
+#
+# The items are read from the search index with a scroll cursor, --page-size items at a time. On
+# Elasticsearch 5 and later the index can be split in --slices parts which are read in parallel, e.g:
+#    /opt/cantemo/python/bin/python calculate_portal_total_items_duration.py --slices 4
+#
+# With --aggregate the sum is calculated by Elasticsearch in a single request, optionally broken down by
+# media type, collection or ingest month, e.g:
+#    /opt/cantemo/python/bin/python calculate_portal_total_items_duration.py --aggregate --breakdown month
+# If the aggregation fails the items are read with the scroll cursor instead.
+#
+# With --state-file the duration of every item is saved in an SQLite database. Then with --incremental only
+# the items created, modified or deleted since the previous run are read, and the saved total is adjusted, e.g:
+#    /opt/cantemo/python/bin/python calculate_portal_total_items_duration.py --state-file durations.db --incremental
+# Items removed from the search index are found by comparing the number of saved and indexed items, and then the IDs
+# of all items are read to remove them from the total.
+# Running without --incremental recalculates everything, and shows the difference to the saved total.
 #
 # This works for Portal version 2.3.x onwards, earlier versions should calculate on 'f_durationSeconds_flt' instead
-# of 'durationSeconds'.
-from portal.search.elastic import query_elastic
-
-searchquery = '{"query": {"filtered": {"filter": {"bool": {"must": [{"and": {"filters": [{"term": {"search_interval": "all"}}]}}, {"missing": {"field": "portal_deleted"}}]}}, "query": {"match_all": {}}}}}'
-
-first = 0
-number = 100
-duration = 0
-
-while True:
-    print "result from " + str(first) + ": " + str(duration) + "s"
-    searchresults = query_elastic(searchquery, first, number)
-    for hit in searchresults['hits']['hits']:
-        if hit["_type"] != "item":
-            continue
-        if 'durationSeconds' in hit['_source']:
-            duration = duration + float(hit['_source']['durationSeconds'][0])     
-    if len(searchresults['hits']['hits']) < number:
-        break
-    first = first + number
+# of 'durationSeconds'. The items are read by their "item" mapping type in the Portal search index, so this supports
+# Elasticsearch 1.x to 6.x. Elasticsearch 7 removed mapping types, and is not supported.
+import datetime
+import optparse
+import os
+import sqlite3
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+sys.path.append("/opt/cantemo/portal")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+
+import django
+
+django.setup()
+# Now Portal/Django environment is setup and the search index settings are available
+
+from django.conf import settings
+from elasticsearch import Elasticsearch, TransportError
+
+parser = optparse.OptionParser()
+parser.add_option("--page-size", dest="page_size", type="int", default=1000,
+                  help="Number of items read from the search index at a time (default 1000)")
+parser.add_option("--slices", dest="slices", type="int", default=1,
+                  help="Number of parts of the index read in parallel, requires Elasticsearch 5 or later (default 1)")
+parser.add_option("--aggregate", dest="aggregate", action="store_true", default=False,
+                  help="Let Elasticsearch calculate the sum instead of reading every item")
+parser.add_option("--breakdown", dest="breakdown", choices=["mediatype", "collection", "month"],
+                  help="With --aggregate, also show the duration per mediatype, collection or month")
+parser.add_option("--state-file", dest="state_file",
+                  help="SQLite database where the durations of the items are saved for --incremental")
+parser.add_option("--incremental", dest="incremental", action="store_true", default=False,
+                  help="Only read the items changed since the previous run with the same --state-file")
+parser.add_option("--overlap-minutes", dest="overlap_minutes", type="int", default=10,
+                  help="With --incremental, also read again the items changed this many minutes before the "
+                       "previous run, which were indexed late or with a different clock (default 10)")
+# Arguments other than the options are ignored, e.g. "shell" if executed with "manage.py shell <"
+(options, args) = parser.parse_args()
+
+if options.page_size < 1:
+    parser.error("Invalid --page-size option.")
+if options.slices < 1:
+    parser.error("Invalid --slices option.")
+if options.breakdown and not options.aggregate:
+    parser.error("--breakdown requires --aggregate.")
+if options.overlap_minutes < 0:
+    parser.error("Invalid --overlap-minutes option.")
+if options.incremental and not options.state_file:
+    parser.error("--incremental requires --state-file.")
+if options.aggregate and options.state_file:
+    parser.error("--aggregate cannot be used with --state-file.")
+
+# Field of the Portal search index with the time an item was last modified, used for --incremental
+MODIFIED_FIELD = 'modified'
+
+# Aggregations used for --breakdown, on the fields of the Portal search index. "interval" is what Elasticsearch 1.x
+# to 6.x support for date_histogram, 7 has "calendar_interval" instead.
+BREAKDOWN_AGGREGATIONS = {
+    'mediatype': {'terms': {'field': 'mediaType', 'size': 100}},
+    'collection': {'terms': {'field': 'collections', 'size': 10000}},
+    'month': {'date_histogram': {'field': 'created', 'interval': 'month', 'format': 'yyyy-MM'}},
+}
+
+# How long Elasticsearch keeps the scroll cursor between two pages
+SCROLL_TIMEOUT = '5m'
+
+# Portal search index, as configured for the search backend in Portal settings
+connection = settings.HAYSTACK_CONNECTIONS['default']
+es = Elasticsearch([connection['URL']])
+index = connection['INDEX_NAME']
+es_major_version = int(es.info()['version']['number'].split('.')[0])
+
+if options.slices > 1 and es_major_version < 5:
+    parser.error("--slices requires Elasticsearch 5 or later, this is %s." % es.info()['version']['number'])
+
+# Mapping type of the item documents in the Portal search index
+ITEM_DOC_TYPE = 'item'
+
+# Without the mapping type, e.g. on Elasticsearch 7, a search for it would find nothing and the total would be 0s
+index_mappings = es.indices.get_mapping(index=index).values()
+if not any(ITEM_DOC_TYPE in index_mapping['mappings'] for index_mapping in index_mappings):
+    parser.error("No '%s' documents in the search index %s, Elasticsearch %s is not supported, only 1.x to 6.x."
+                 % (ITEM_DOC_TYPE, index, es.info()['version']['number']))
+
+
+def get_searchquery(include_deleted=False, modified_since=None, with_duration=False):
+    """
+    Returns the query for all items, optionally including the deleted items, only the items modified
+    since a time and only the items with a duration.
+    """
+    filters = [{"term": {"search_interval": "all"}}]
+    if modified_since:
+        filters.append({"range": {MODIFIED_FIELD: {"gte": modified_since}}})
+    if with_duration:
+        filters.append({"exists": {"field": "durationSeconds"}})
+
+    if es_major_version < 5:
+        must = [{"and": {"filters": filters}}]
+        if not include_deleted:
+            must.append({"missing": {"field": "portal_deleted"}})
+        return {"query": {"filtered": {"filter": {"bool": {"must": must}}, "query": {"match_all": {}}}}}
+
+    # "filtered" and "missing" were removed in Elasticsearch 5
+    query = {"bool": {"filter": filters}}
+    if not include_deleted:
+        query["bool"]["must_not"] = [{"exists": {"field": "portal_deleted"}}]
+    return {"query": query}
+
+
+searchquery = get_searchquery()
+
+# Leave everything but the durations out of the scroll responses (Elasticsearch 1.6 and later), so
+# there is little to transfer and decode. _id keeps the hits without a duration in the response.
+response_filter = {}
+if es_major_version >= 2:
+    response_filter['filter_path'] = ['_scroll_id', 'hits.total', 'hits.hits._id', 'hits.hits._source.durationSeconds',
+                                      'hits.hits._source.portal_deleted']
+
+print_lock = threading.Lock()
+
+
+def get_hit_duration(hit):
+    """
+    Returns the duration of an item in the search results, None if it has no duration.
+    """
+    if 'durationSeconds' in hit.get('_source', {}):
+        return float(hit['_source']['durationSeconds'][0])
+    return None
+
+
+def sum_slice_duration(slice_id, query=None, handle_hits=None):
+    """
+    Reads all items in one slice of the index with a scroll cursor and returns their total duration.
+
+    handle_hits is called with the hits of every page.
+    """
+    # Only the duration (and if deleted) is needed from the item documents
+    body = dict(query or searchquery, _source=['durationSeconds', 'portal_deleted'])
+    if options.slices > 1:
+        body['slice'] = {'id': slice_id, 'max': options.slices}
+
+    duration = 0
+    processed = 0
+    searchresults = es.search(index=index, doc_type=ITEM_DOC_TYPE, body=body, scroll=SCROLL_TIMEOUT,
+                              size=options.page_size, **response_filter)
+    try:
+        while searchresults['hits'].get('hits'):
+            for hit in searchresults['hits']['hits']:
+                hit_duration = get_hit_duration(hit)
+                if hit_duration is not None:
+                    duration = duration + hit_duration
+            if handle_hits:
+                handle_hits(searchresults['hits']['hits'])
+            processed += len(searchresults['hits']['hits'])
+            with print_lock:
+                print "slice %s, result to %s/%s: %ss" % (slice_id, processed, searchresults['hits']['total'], duration)
+            searchresults = es.scroll(scroll_id=searchresults['_scroll_id'], scroll=SCROLL_TIMEOUT, **response_filter)
+    finally:
+        # Release the cursor now instead of waiting for the timeout
+        es.clear_scroll(scroll_id=searchresults['_scroll_id'], ignore=(404,))
+    return duration
+
+
+def aggregate_duration():
+    """
+    Returns the total duration calculated by Elasticsearch, and a list of (key, duration, number of
+    items) with --breakdown.
+    """
+    duration_sum = {'sum': {'field': 'durationSeconds'}}
+    body = dict(searchquery, size=0, aggs={'duration': duration_sum})
+    if options.breakdown:
+        body['aggs']['breakdown'] = dict(BREAKDOWN_AGGREGATIONS[options.breakdown], aggs={'duration': duration_sum})
+
+    searchresults = es.search(index=index, doc_type=ITEM_DOC_TYPE, body=body)
+    aggregations = searchresults['aggregations']
+    breakdown = []
+    if options.breakdown:
+        for bucket in aggregations['breakdown']['buckets']:
+            breakdown.append((bucket.get('key_as_string', bucket['key']), bucket['duration']['value'],
+                              bucket['doc_count']))
+    return aggregations['duration']['value'], breakdown
+
+
+class DurationStore(object):
+    """
+    SQLite database with the duration of every item, and the time of the previous run.
+    """
+    def __init__(self, path):
+        # Hits are saved from the threads reading the slices, one at a time
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS duration (item_id TEXT PRIMARY KEY, seconds REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.db.commit()
+
+    def get_watermark(self):
+        row = self.db.execute("SELECT value FROM state WHERE key = 'watermark'").fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, watermark):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('watermark', ?)", (watermark,))
+            self.db.commit()
+
+    def get_total(self):
+        return self.db.execute("SELECT COALESCE(SUM(seconds), 0) FROM duration").fetchone()[0]
+
+    def get_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM duration").fetchone()[0]
+
+    def clear(self):
+        with self.lock:
+            # Without a watermark the next run reads all items, if this one does not finish
+            self.db.execute("DELETE FROM state WHERE key = 'watermark'")
+            self.db.execute("DELETE FROM duration")
+            self.db.commit()
+
+    def save_hits(self, hits):
+        updated = []
+        removed = []
+        for hit in hits:
+            hit_duration = get_hit_duration(hit)
+            if hit_duration is None or 'portal_deleted' in hit.get('_source', {}):
+                removed.append((hit['_id'],))
+            else:
+                updated.append((hit['_id'], hit_duration))
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO duration (item_id, seconds) VALUES (?, ?)", updated)
+            self.db.executemany("DELETE FROM duration WHERE item_id = ?", removed)
+            self.db.commit()
+
+    def remove_missing(self, item_ids):
+        """
+        Removes the items which are not in item_ids, returns the number of removed items.
+        """
+        with self.lock:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS indexed (item_id TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM indexed")
+            self.db.executemany("INSERT OR IGNORE INTO indexed (item_id) VALUES (?)",
+                                ((item_id,) for item_id in item_ids))
+            removed = self.db.execute(
+                "DELETE FROM duration WHERE item_id NOT IN (SELECT item_id FROM indexed)").rowcount
+            self.db.commit()
+        return removed
+
+
+def sum_duration(query=None, handle_hits=None):
+    pool = ThreadPool(options.slices)
+    total = sum(pool.map(lambda slice_id: sum_slice_duration(slice_id, query, handle_hits), range(options.slices)))
+    pool.close()
+    return total
+
+
+duration = None
+if options.state_file:
+    store = DurationStore(options.state_file)
+    watermark = store.get_watermark()
+    # Items modified during this run are read again on the next one, and the ones modified shortly before it, as
+    # Portal indexes an item some time after it is modified and the clocks can differ. Reading an item again only
+    # replaces its saved duration.
+    run_started = (datetime.datetime.utcnow() - datetime.timedelta(minutes=options.overlap_minutes)).strftime(
+        '%Y-%m-%dT%H:%M:%S')
+    if options.incremental and watermark:
+        print "Reading items changed since %s, previous total was %ss" % (watermark, store.get_total())
+        # Deleted items are included to remove them from the total
+        sum_duration(get_searchquery(include_deleted=True, modified_since=watermark), store.save_hits)
+        # Items removed from the search index, e.g. purged from the trash, are not found by modification time,
+        # but then fewer items with a duration are in the index than saved
+        with_duration = get_searchquery(with_duration=True)
+        indexed = es.count(index=index, doc_type=ITEM_DOC_TYPE, body=with_duration)['count']
+        if indexed != store.get_count():
+            print "%s items saved but %s in the search index, reading the IDs of all items to remove the missing" \
+                  % (store.get_count(), indexed)
+            indexed_ids = set()
+            sum_duration(with_duration, lambda hits: indexed_ids.update(hit['_id'] for hit in hits))
+            print "Removed %s items which are not in the search index" % store.remove_missing(indexed_ids)
+            if store.get_count() < len(indexed_ids):
+                print "Warning: %s items in the search index are not saved, run without --incremental to " \
+                      "recalculate the total" % (len(indexed_ids) - store.get_count())
+        duration = store.get_total()
+    else:
+        previous_total = store.get_total() if watermark else None
+        store.clear()
+        duration = sum_duration(handle_hits=store.save_hits)
+        if previous_total is not None:
+            print "Previous total was %ss, difference %ss" % (previous_total, duration - previous_total)
+    store.set_watermark(run_started)
+
+elif options.aggregate:
+    try:
+        duration, breakdown = aggregate_duration()
+        for key, key_duration, key_items in breakdown:
+            print "%s: %ss (%s items)" % (key, key_duration, key_items)
+    except TransportError as e:
+        print "Aggregation failed, reading all items instead: %s" % e
+
+if duration is None:
+    duration = sum_duration()
 
 print "Total duration is " + str(duration) + "s"
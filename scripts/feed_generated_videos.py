@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+# This script feeds files created with generate_random_videos.py into a storage directory watched by auto-import,
+# at a controlled rate, to measure ingest latency and throughput under sustained load.
+#
+# Files are copied (or moved with --move) keeping their xxx/yyy/<sha1> paths, either at a constant --rate in files
+# per second, or in bursts of --burst files every --interval seconds. The time each file started to be written and
+# was complete in the storage is written to --log, one JSON object per line, to compare with the auto-import job
+# times, e.g. with the autoimport-wait-transcoding-closed and autoimport-wait-hash jobsteps.
+#
+# Example, 5 files per second from the current directory into /mnt/storage/ingest:
+#    python feed_generated_videos.py --rate 5 . /mnt/storage/ingest
+#
+# Example, 100 files every minute, only the files listed in a manifest:
+#    python feed_generated_videos.py --burst 100 --interval 60 --manifest manifest.jsonl . /mnt/storage/ingest
+
+from __future__ import print_function
+
+import json
+import optparse
+import os
+import shutil
+import sys
+import time
+
+parser = optparse.OptionParser(usage="usage: %prog [options] <source directory> <storage directory>")
+parser.add_option("--rate", dest="rate", type="float", default=1,
+                  help="Files per second (default %default)")
+parser.add_option("--burst", dest="burst", type="int",
+                  help="Instead of a constant rate, add this many files at once every --interval seconds")
+parser.add_option("--interval", dest="interval", type="float", default=60,
+                  help="Seconds between bursts (default %default)")
+parser.add_option("--limit", dest="limit", type="int",
+                  help="Stop after this many files")
+parser.add_option("--move", dest="move", action="store_true", default=False,
+                  help="Move the files instead of copying them")
+parser.add_option("--atomic", dest="atomic", action="store_true", default=False,
+                  help="Write each file under a hidden name and rename it when complete, so it is never seen growing")
+parser.add_option("--manifest", dest="manifest",
+                  help="Only feed the files listed in this manifest from generate_random_videos.py --profile")
+parser.add_option("--log", dest="log", default="arrivals.jsonl",
+                  help="File where the arrival times are written (default %default)")
+(options, args) = parser.parse_args()
+
+if len(args) != 2:
+    parser.print_usage()
+    exit(1)
+if options.rate <= 0:
+    parser.error("Invalid --rate option.")
+if options.burst is not None and (options.burst < 1 or options.interval <= 0):
+    parser.error("Invalid --burst or --interval option.")
+
+source_dir, storage_dir = args
+
+
+def get_source_paths():
+    """
+    Paths of the files to feed, relative to the source directory, in a stable order.
+    """
+    if options.manifest:
+        listed = set()
+        with open(options.manifest) as manifest_input:
+            for line in manifest_input:
+                # A file is listed again for each run of generate_random_videos.py
+                path = json.loads(line)["path"]
+                if path not in listed:
+                    listed.add(path)
+                    yield path
+        return
+
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        # Skip temporary files of an ongoing or interrupted generate_random_videos.py run
+        for filename in sorted(filenames):
+            if ".tmp." not in filename and filename.endswith((".mov", ".mp4", ".mxf", ".mkv")):
+                yield os.path.relpath(os.path.join(dirpath, filename), source_dir)
+        # Image sequences are directories, fed as a whole
+        for dirname in list(dirnames):
+            if len(dirname) == 40 and not dirname.endswith(".tmp"):
+                dirnames.remove(dirname)
+                yield os.path.relpath(os.path.join(dirpath, dirname), source_dir)
+
+
+def feed_file(path):
+    """
+    Copy or move a file or image sequence directory into the storage.
+
+    :return: Size in bytes
+    """
+    source = os.path.join(source_dir, path)
+    target = os.path.join(storage_dir, path)
+    target_dir = os.path.dirname(target)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    if options.atomic:
+        write_target = os.path.join(target_dir, "." + os.path.basename(target))
+    else:
+        write_target = target
+
+    if os.path.isdir(source):
+        size = sum(os.path.getsize(os.path.join(source, name)) for name in os.listdir(source))
+        if options.move:
+            shutil.move(source, write_target)
+        else:
+            shutil.copytree(source, write_target)
+    else:
+        size = os.path.getsize(source)
+        if options.move:
+            shutil.move(source, write_target)
+        else:
+            shutil.copyfile(source, write_target)
+
+    if write_target != target:
+        os.rename(write_target, target)
+    return size
+
+
+def get_scheduled_time(start_time, number):
+    """
+    Time when file number (from 0) should be added.
+    """
+    if options.burst:
+        return start_time + (number // options.burst) * options.interval
+    return start_time + number / options.rate
+
+
+log = open(options.log, "a")
+fed = 0
+skipped = 0
+total_bytes = 0
+behind = 0
+start_time = time.time()
+try:
+    for path in get_source_paths():
+        if options.limit is not None and fed >= options.limit:
+            break
+        if os.path.exists(os.path.join(storage_dir, path)):
+            # Fed by a previous run
+            skipped += 1
+            continue
+
+        # Keep to the schedule instead of sleeping a fixed time, so the time taken to copy does not lower the rate
+        delay = get_scheduled_time(start_time, fed) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1:
+            behind += 1
+
+        started = time.time()
+        size = feed_file(path)
+        arrived = time.time()
+        log.write(json.dumps({"path": path, "bytes": size, "started": started, "arrived": arrived}) + "\n")
+        log.flush()
+        fed += 1
+        total_bytes += size
+
+        if fed % 100 == 0:
+            elapsed = arrived - start_time
+            print("%d files, %.1f MB in %.0fs: %.2f files/s, %.1f MB/s" % (
+                fed, total_bytes / 1e6, elapsed, fed / elapsed, total_bytes / 1e6 / elapsed))
+except KeyboardInterrupt:
+    print("Interrupted")
+finally:
+    log.close()
+
+elapsed = time.time() - start_time
+print("Fed %d files, %.1f MB in %.0fs, %d already in the storage" % (fed, total_bytes / 1e6, elapsed, skipped))
+if behind:
+    print("%d files were added more than 1s late, copying could not keep up with the rate" % behind)
+if fed == 0 and skipped == 0:
+    sys.exit(1)
@@ -1,32 +1,269 @@
 #!/usr/bin/python
 
 # This script generates random video files of 1s length with the sha1 checksum a number as the filename, and burned into the video
+#
+# Files are encoded by --jobs parallel ffmpeg processes, by default one per CPU core.
+#
+# With --fast only one template video is encoded, and each file is a copy of it with the checksum added
+# in a "free" atom at the end of the file. The files are still valid and unique, but the checksum is not
+# visible in the video. This is limited by disk speed instead of CPU.
+#
+# With --profile the files are generated with a mix of durations, resolutions, codecs, containers, audio
+# tracks, sizes and image sequences given in a JSON file, see generate_random_videos_profile_example.json.
+# Each variant in the profile has a weight, and each value is either fixed, a list to pick from, or a
+# {"min": x, "max": y} range. The choices are seeded by the checksum, so the same number always gives the
+# same file. What was generated is written to --manifest, one JSON object per line.
 
-import os
 import hashlib
-import sys
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import signal
+import struct
 import subprocess
+import sys
+import tempfile
+import time
 
-if len(sys.argv) != 2:
-    print "usage: %s <number>" % sys.argv[0]
+parser = optparse.OptionParser(usage="usage: %prog [--jobs N] [--fast | --profile FILE] <number>")
+parser.add_option("--jobs", dest="jobs", type="int", default=multiprocessing.cpu_count(),
+                  help="Number of files encoded in parallel (default: number of CPU cores, %default)")
+parser.add_option("--fast", dest="fast", action="store_true", default=False,
+                  help="Copy one template video with a unique checksum atom, instead of encoding every file")
+parser.add_option("--profile", dest="profile",
+                  help="JSON file with the variants of files to generate")
+parser.add_option("--manifest", dest="manifest", default="manifest.jsonl",
+                  help="File where the generated files are listed with --profile (default %default)")
+(options, args) = parser.parse_args()
+
+if len(args) != 1:
+    parser.print_usage()
     exit(1)
+if options.jobs < 1:
+    parser.error("Invalid --jobs option.")
+if options.fast and options.profile:
+    parser.error("--fast cannot be used with --profile.")
 
-num = int(sys.argv[1])
+num = int(args[0])
 
 print num
 
+# The original files: 1s black 640x480 H.264 at 25fps in a QuickTime container
+DEFAULT_VARIANT = {
+    "name": "default",
+    "duration": 1,
+    "resolution": "640x480",
+    "fps": 25,
+    "codec": "libx264",
+    "container": "mov",
+    "audio_tracks": 0,
+    "audio_codec": "aac",
+}
+
+# Pixel format used when the variant does not set one, for codecs which do not support yuv420p
+CODEC_PIX_FMTS = {
+    "prores_ks": "yuv422p10le",
+    "dnxhd": "yuv422p",
+    "ffv1": "yuv422p",
+}
+
+variants = [dict(DEFAULT_VARIANT, weight=1)]
+if options.profile:
+    try:
+        with open(options.profile) as profile_input:
+            profile = json.load(profile_input)
+        variants = [dict(DEFAULT_VARIANT, **variant) for variant in profile["variants"]]
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        parser.error("Cannot read --profile: %s" % e)
+    if not variants or any(variant.get("weight", 1) <= 0 for variant in variants):
+        parser.error("The --profile should have variants with a positive weight.")
+
+# Contents of the template video with --fast
+template_data = None
+
+
+def choose_value(rnd, value):
+    """
+    A value from a variant: a list is a choice, {"min": x, "max": y} a range, anything else fixed.
+    """
+    if isinstance(value, list):
+        return rnd.choice(value)
+    if isinstance(value, dict) and "min" in value and "max" in value:
+        if isinstance(value["min"], int) and isinstance(value["max"], int):
+            return rnd.randint(value["min"], value["max"])
+        return rnd.uniform(value["min"], value["max"])
+    return value
+
+
+def choose_params(txt):
+    """
+    Choose the parameters of a file from the variants, always the same for the same checksum.
+    """
+    rnd = random.Random(int(txt, 16))
+    point = rnd.uniform(0, sum(variant.get("weight", 1) for variant in variants))
+    for variant in variants:
+        point -= variant.get("weight", 1)
+        if point <= 0:
+            break
+    params = dict((key, choose_value(rnd, value)) for key, value in variant.items() if key != "weight")
+    if "pix_fmt" not in params and not params.get("frames"):
+        # Image formats get their default pixel format
+        params["pix_fmt"] = CODEC_PIX_FMTS.get(params["codec"], "yuv420p")
+    return params
+
+
+def encode_video(path, text, params=DEFAULT_VARIANT):
+    """
+    Encode a video with text burned into it. If params has "frames", path is an image file name pattern
+    like name_%06d.dpx.
 
-for i in range(1, num):
+    :return: True if successful
+    """
+    cmd = ["ffmpeg", "-y", "-loglevel", "error"]
+    if params.get("size_mb"):
+        # Noise does not compress, so the bitrate gives the file size
+        cmd += ["-f", "lavfi", "-i", "nullsrc=s=%s,geq=random(1)*255:128:128" % params["resolution"]]
+    else:
+        cmd += ["-f", "lavfi", "-i", "color=c=black:s=%s" % params["resolution"]]
+    for track in range(params["audio_tracks"]):
+        cmd += ["-f", "lavfi", "-i", "sine=frequency=%d:sample_rate=48000" % (440 + 110 * track)]
+    cmd += ["-vf", "drawtext=text=%s:fontcolor=white:fontsize=32:x=(w-tw)/2:y=h/2" % text]
+    if params.get("frames"):
+        cmd += ["-frames:v", str(params["frames"])]
+    else:
+        cmd += ["-t", str(params["duration"]), "-c:v", params["codec"]]
+    if params.get("pix_fmt"):
+        cmd += ["-pix_fmt", params["pix_fmt"]]
+    cmd += ["-r", str(params["fps"])]
+    if params.get("size_mb"):
+        bitrate = "%dk" % (params["size_mb"] * 8 * 1024 / float(params["duration"]))
+        cmd += ["-b:v", bitrate, "-minrate", bitrate, "-maxrate", bitrate, "-bufsize", bitrate]
+    if params["audio_tracks"]:
+        cmd += ["-map", "0:v"]
+        for track in range(params["audio_tracks"]):
+            cmd += ["-map", "%d:a" % (track + 1)]
+        cmd += ["-c:a", params["audio_codec"]]
+    cmd.append(path)
+    return subprocess.call(cmd) == 0
+
+
+def write_template_copy(path, text):
+    """
+    Write the template video with text in a "free" atom at the end, which players and Vidispine ignore.
+    """
+    with open(path, "wb") as output:
+        output.write(template_data)
+        output.write(struct.pack(">I4s", 8 + len(text), "free"))
+        output.write(text)
+    return True
+
+
+def get_size(path):
+    """
+    Size of a file, or of all files in an image sequence directory, in bytes.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def generate_video(i):
+    """
+    Create the video for number i, unless it already exists.
+
+    :return: (path, status, params), status is "created", "exists" or "failed"
+    """
     checksum = hashlib.sha1()
     checksum.update("%d" % i)
     txt = checksum.hexdigest()
     dir = "%s/%s" % (txt[0:3], txt[3:6])
-    path = "%s/%s.mov" % (dir, txt)
+    params = choose_params(txt)
+    if params.get("frames"):
+        # Image sequence, in a directory
+        path = "%s/%s" % (dir, txt)
+    else:
+        path = "%s/%s.%s" % (dir, txt, params["container"])
     try:
         os.makedirs(dir)
     except:
         pass
 
-    if not os.path.exists(path):
-        cmd = "ffmpeg -y -f lavfi -i color=c=black:s=640x480 -vf 'drawtext=text=%s:fontcolor=white:fontsize=32:x=(w-tw)/2:y=h/2' -t 1 -c:v libx264 -pix_fmt yuv420p -r 25  %s" % (txt, path)
-        subprocess.call(cmd, shell=True)
+    if os.path.exists(path):
+        return path, "exists", params
+
+    # Write to a temporary file, so an interrupted encode does not leave a partial file that would be
+    # skipped on the next run
+    if params.get("frames"):
+        tmp_path = "%s/%s.tmp" % (dir, txt)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        success = encode_video("%s/%s_%%06d.%s" % (tmp_path, txt, params["container"]), txt, params)
+    else:
+        tmp_path = "%s/%s.tmp.%s" % (dir, txt, params["container"])
+        if template_data is not None:
+            success = write_template_copy(tmp_path, txt)
+        else:
+            success = encode_video(tmp_path, txt, params)
+    if not success:
+        return path, "failed", params
+    os.rename(tmp_path, path)
+    return path, "created", params
+
+
+def init_worker():
+    # Ctrl-C is handled by the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+if options.fast:
+    template_dir = tempfile.mkdtemp()
+    try:
+        template_path = os.path.join(template_dir, "template.mov")
+        if not encode_video(template_path, "generate_random_videos.py"):
+            print "Failed to create the template video"
+            exit(1)
+        with open(template_path, "rb") as template_input:
+            template_data = template_input.read()
+    finally:
+        shutil.rmtree(template_dir)
+
+manifest = None
+if options.profile:
+    manifest = open(options.manifest, "a")
+
+# Workers are forked after reading the template, and share it
+pool = multiprocessing.Pool(options.jobs, init_worker)
+counts = {"created": 0, "exists": 0, "failed": 0}
+start_time = time.time()
+try:
+    results = pool.imap_unordered(generate_video, range(1, num))
+    for done in range(1, num):
+        while True:
+            try:
+                # A timeout keeps the wait interruptible by Ctrl-C, a file can take longer to encode
+                path, status, params = results.next(5)
+                break
+            except multiprocessing.TimeoutError:
+                continue
+        counts[status] += 1
+        if status == "failed":
+            print "Failed to create %s" % path
+        elif manifest:
+            manifest.write(json.dumps(dict(params, path=path, status=status, bytes=get_size(path))) + "\n")
+        if done % 100 == 0 or done == num - 1:
+            print "%d/%d files, %d created, %d existed, %d failed, %.1f files/s" % (
+                done, num - 1, counts["created"], counts["exists"], counts["failed"],
+                done / (time.time() - start_time))
+    pool.close()
+except KeyboardInterrupt:
+    print "Interrupted, stopping..."
+    pool.terminate()
+    pool.join()
+    sys.exit(1)
+finally:
+    if manifest:
+        manifest.close()
+pool.join()
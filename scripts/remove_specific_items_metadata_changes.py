@@ -13,7 +13,18 @@ import requests
 import ConfigParser
 import json
 import dateutil.parser
+import dateutil.relativedelta
 import calendar
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+import Queue
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 
 class FormattedOptionParser(optparse.OptionParser):
@@ -34,6 +45,36 @@ So for instance, the following options would be valid:
 * 2018-05-08 - May 8th 2018
 
 Seconds will never be taken into account, even if specified.
+
+The changes of the items can be fetched concurrently with the --workers option. All workers share
+one pooled HTTP connection to Vidispine. Use --max-requests-per-second to avoid overloading the
+server, failed requests (connection errors, HTTP 429/5xx) are retried with an exponential backoff.
+The matching changes are removed by --remove-workers concurrent requests while the scan continues.
+For instance:
+
+%prog --user admin --metadatafield portal_mf123456 --date 2018-05 --text foo --workers 8 \
+    --max-requests-per-second 50
+
+Many rules can be matched in one scan using --rules with a JSON file, for instance:
+
+[
+  {"user": "admin", "metadatafield": "portal_mf123456", "date": "2018-05", "text": "foo"},
+  {"user": "bob", "metadatafield": "portal_mf654321", "date": "2018-05-08", "text": "bar"}
+]
+
+With --search-first 1 the changes are only fetched for the items found with a Vidispine search on
+the metadata field containing the text (for any of the rules), created before the end of the date period. This is much
+faster, but only finds the items where the field still contains the text. Text with spaces or the
+characters * ? " \\ cannot be searched for exactly, so with such text all items are scanned.
+
+With --state-file the progress is saved to a file, and running the script again with the same
+options and state file continues from where it stopped. The items found with --dry-run 1 can be
+removed later without scanning again with --replay 1, for instance:
+
+%prog --user admin --metadatafield portal_mf123456 --date 2018-05 --text foo --dry-run 1 \
+    --state-file foo.jsonl
+%prog --user admin --metadatafield portal_mf123456 --date 2018-05 --text foo --replay 1 \
+    --state-file foo.jsonl
 """
 
 parser = FormattedOptionParser(epilog=PARSER_HELP_EPILOG)
@@ -50,177 +91,614 @@ parser.add_option("--date", dest="timestamp",
 parser.add_option("--text", dest="text_to_match",
                   help="Text to match")
 
+parser.add_option("--rules", dest="rules",
+                  help="A JSON file with a list of rules to match, instead of --user, --metadatafield, --date and --text")
+
 parser.add_option("--dry-run", dest="dry_run", type="int",
                   help="If set to 1, list the items hose match the given patterns, without applying the changes",
                   default=0)
 
-(options, args) = parser.parse_args()
+parser.add_option("--search-first", dest="search_first", type="int",
+                  help="If set to 1, only look for changes on the items found by searching for the text in the field",
+                  default=0)
 
-config = ConfigParser.SafeConfigParser()
-config.read('/etc/cantemo/portal/portal.conf')
-vs_username = config.get("vidispine", "VIDISPINE_USERNAME")
-vs_password = config.get("vidispine", "VIDISPINE_PASSWORD")
-vs_hostname = config.get("vidispine", "VIDISPINE_URL")
-vs_port = config.get("vidispine", "VIDISPINE_PORT")
-vs_baseurl = "%s:%s/API" % (vs_hostname, vs_port)
+parser.add_option("--state-file", dest="state_file",
+                  help="File where the progress is saved, to resume an interrupted run")
 
-# validate text
-if options.text_to_match is None:
-    parser.error("Option --text not provided.")
+parser.add_option("--replay", dest="replay", type="int",
+                  help="If set to 1, remove the changes found in --state-file, without looking for new changes",
+                  default=0)
 
-# validate user
-if options.user is None:
-    parser.error("Option --user not provided.")
+parser.add_option("--workers", dest="workers", type="int",
+                  help="Number of concurrent requests used to fetch the item changes (default 1)",
+                  default=1)
 
-# validate meta field name format:
-if options.metadatafield is None:
-    parser.error("Option --metadatafield not provided.")
-else:
+parser.add_option("--remove-workers", dest="remove_workers", type="int",
+                  help="Number of concurrent requests used to remove the changes while scanning continues (default 1)",
+                  default=1)
+
+parser.add_option("--max-requests-per-second", dest="max_requests_per_second", type="float",
+                  help="Maximum number of requests per second made to Vidispine, 0 for no limit (default 0)",
+                  default=0)
+
+parser.add_option("--retries", dest="retries", type="int",
+                  help="Number of times a failed request is retried, with exponential backoff (default 3)",
+                  default=3)
+
+parser.add_option("--config", dest="config",
+                  help="Portal configuration file to read the Vidispine settings from "
+                       "(default /etc/cantemo/portal/portal.conf)",
+                  default='/etc/cantemo/portal/portal.conf')
+
+RULE_OPTIONS = ['user', 'metadatafield', 'date', 'text']
+
+
+def get_rule_error(rule):
+    """
+    Validates the match criteria of a rule, returns None if valid or the error message.
+    """
+    for option in RULE_OPTIONS:
+        if rule.get(option) is None:
+            return "Option --%s not provided." % option
+        if not isinstance(rule[option], basestring):
+            return "Option --%s should be a text." % option
+
+    # validate meta field name format:
     pattern = re.compile("^portal_mf\d{6}$")
-    field_matches_pattern = pattern.match(options.metadatafield)
+    field_matches_pattern = pattern.match(rule['metadatafield'])
     if not field_matches_pattern:
-        parser.error("Invalid Metadata Field Name. It should be in the following format: portal_mfXXXXXX.")
+        return "Invalid Metadata Field Name. It should be in the following format: portal_mfXXXXXX."
 
-# va1idate timestamp format
-if options.timestamp is None:
-    parser.error("Option --date not provided.")
-else:
-    # valid options are like:
+    # va1idate timestamp format, valid options are like:
     # + 2018
     # + 2018-01
     # + 2018-01-01
     isoformat_date_pattern = re.compile('^\d{4}(-\d\d(-\d\d)?)?$')
-    timestamp_matches_pattern = isoformat_date_pattern.match(options.timestamp)
+    timestamp_matches_pattern = isoformat_date_pattern.match(rule['date'])
 
     if not timestamp_matches_pattern:
-        parser.error("Invalid date format. Look at the help for more information.")
+        return "Invalid date format. Look at the help for more information."
 
     try:
-        dateutil.parser.parse(options.timestamp)
+        dateutil.parser.parse(rule['date'])
     except calendar.IllegalMonthError:
-        parser.error("Invalid Month Value. Look at the help for more information.")
+        return "Invalid Month Value. Look at the help for more information."
     except ValueError as e:
-        parser.error("date field error: %s" % e.message)
-
-    # remove seconds if included:
-    if len(options.timestamp) == 19:
-        options.timestamp = options.timestamp[:-3]
-
-if options.dry_run not in [1, 0]:
-    parser.error("Invalid --dry-run option.")
-dry_run = options.dry_run == 1
-
-
-def get_all_items_ids():
-    number = 1000
-    processed = 0
-    hits = 1
-    matrix = {'number': number}
-    items_ids = []
-
-    while processed < hits:
-        first = processed + 1
-        rest_url = '%s/item;number=%s;first=%s' % (vs_baseurl, number, first)
-        result = requests.get(rest_url,
-                              params={'matrix': matrix},
-                              auth=(vs_username, vs_password),
-                              headers={'accept': 'application/json'}
-                              )
-
-        result = json.loads(result.content)
-        hits = int(result['hits'])
-
-        if len(result['item']) < 1:
-            break
-
-        result_items_ids = [item["id"] for item in result['item']]
-        items_ids += result_items_ids
-        processed += len(result_items_ids)
-
-    # return set, so we avoid duplicated ids in case they exist.
-    return set(items_ids)
+        return "date field error: %s" % e.message
+
+    return None
+
+
+class RateLimiter(object):
+    """
+    Limits the number of requests per second made from all threads.
+    """
+    def __init__(self, max_per_second):
+        self.interval = 1.0 / max_per_second if max_per_second else 0
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            if self.next_time > now:
+                time.sleep(self.next_time - now)
+                now = self.next_time
+            self.next_time = now + self.interval
+
+
+def create_session(pool_size, retries):
+    """
+    Creates a HTTP session with keep-alive connections shared by all the workers. Connection
+    errors and 429/5xx responses are retried with an exponential backoff.
+    """
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    new_session = requests.Session()
+    new_session.auth = (vs_username, vs_password)
+    new_session.headers['accept'] = 'application/json'
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    return new_session
+
+
+def imap_threaded(function, iterable, workers):
+    """
+    Applies function to every element of iterable using a number of worker threads, and yields
+    the (element, result) tuples in the order they are completed.
+
+    Only a few elements are read ahead of the workers, so the iterable is consumed as the
+    work progresses.
+    """
+    if workers == 1:
+        for element in iterable:
+            yield element, function(element)
+        return
+
+    end_marker = object()
+    tasks = Queue.Queue(maxsize=workers * 2)
+    results = Queue.Queue(maxsize=workers * 2)
+
+    def feed():
+        try:
+            for element in iterable:
+                tasks.put(element)
+        except Exception:
+            # E.g. an error listing a page of item IDs, raised again in the main thread
+            results.put(sys.exc_info())
+        finally:
+            # Otherwise the workers, and the main thread waiting for them, would never finish
+            for _ in range(workers):
+                tasks.put(end_marker)
+
+    def work():
+        while True:
+            element = tasks.get()
+            if element is end_marker:
+                results.put(end_marker)
+                return
+            try:
+                results.put((element, function(element)))
+            except Exception:
+                # Raised again in the main thread
+                results.put(sys.exc_info())
+
+    threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        # Do not keep the script running if the main thread exits on error
+        thread.daemon = True
+        thread.start()
+
+    finished_workers = 0
+    while finished_workers < workers:
+        result = results.get()
+        if result is end_marker:
+            finished_workers += 1
+        elif len(result) == 3:
+            raise result[0], result[1], result[2]
+        else:
+            yield result
+
+
+class RecentlySeen(object):
+    """
+    A set which only remembers the latest max_size added values.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.values = collections.OrderedDict()
+
+    def __contains__(self, value):
+        return value in self.values
+
+    def add(self, value):
+        self.values[value] = None
+        if len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+
+
+def get_date_period(timestamp):
+    """
+    Returns the start and end datetime of a --date value, e.g. 2018-05 -> (2018-05-01, 2018-06-01)
+    """
+    parts = [int(part) for part in timestamp[:10].split('-')]
+    start = datetime.datetime(*(parts + [1] * (3 - len(parts))))
+    if len(parts) == 1:
+        period = dateutil.relativedelta.relativedelta(years=1)
+    elif len(parts) == 2:
+        period = dateutil.relativedelta.relativedelta(months=1)
+    else:
+        period = dateutil.relativedelta.relativedelta(days=1)
+    return start, start + period
+
+
+# Text which can be searched for with a wildcard search: no whitespace, which splits the search
+# value, and no wildcard, quote or escape characters.
+SEARCHABLE_TEXT_PATTERN = re.compile(r'^[^\s*?"\\]+$')
+
+
+def get_unsearchable_texts(rules):
+    """
+    Returns the texts of the rules which a Vidispine search would not match the same way as the
+    substring test of the changes.
+    """
+    return [rule['text'] for rule in rules if not SEARCHABLE_TEXT_PATTERN.match(rule['text'])]
+
+
+def get_search_document(rules):
+    """
+    Returns an ItemSearchDocument for the items which can have the changes to remove.
+    """
+    rules_operators = []
+    for rule in rules:
+        _, period_end = get_date_period(rule['date'])
+        rules_operators.append({
+            'operation': 'AND',
+            'field': [
+                {'name': rule['metadatafield'], 'value': [{'value': '*%s*' % rule['text']}]},
+                # Vidispine can not search on when a field was changed, but items created after the
+                # period cannot have changes during it.
+                {'name': 'created', 'range': [{'value': [{'value': '1970-01-01T00:00:00Z'},
+                                                         {'value': period_end.strftime('%Y-%m-%dT%H:%M:%SZ')}]}]},
+            ]
+        })
+    return {'operator': {'operation': 'OR', 'operator': rules_operators}}
+
+
+class ItemsIds(object):
+    """
+    Iterates the IDs of all items, or the items matching search_document, fetching them one page
+    at a time from Vidispine.
+
+    The number of items is available in hits once the first page has been fetched.
+    """
+    def __init__(self, search_document=None, page_size=1000, pages_to_deduplicate=10):
+        self.search_document = search_document
+        self.page_size = page_size
+        self.hits = None
+        # Items created or removed while paging shift the later pages, so the same ID can be returned
+        # twice, but only on pages close to each other.
+        self.seen = RecentlySeen(page_size * pages_to_deduplicate)
+
+    def __iter__(self):
+        number = self.page_size
+        processed = 0
+        hits = 1
+        matrix = {'number': number}
+
+        while processed < hits:
+            first = processed + 1
+            rest_url = '%s/item;number=%s;first=%s' % (vs_baseurl, number, first)
+            rate_limiter.wait()
+            if self.search_document:
+                result = session.put(rest_url, json=self.search_document)
+            else:
+                result = session.get(rest_url, params={'matrix': matrix})
+
+            result = json.loads(result.content)
+            hits = self.hits = int(result['hits'])
+            # No "item" in the result when a search has no matches
+            result_items = result.get('item', [])
+
+            if len(result_items) < 1:
+                break
+
+            for item in result_items:
+                # avoid duplicated ids in case they exist.
+                if item["id"] not in self.seen:
+                    self.seen.add(item["id"])
+                    yield item["id"]
+            processed += len(result_items)
 
 
 def get_item_changes(item_id):
-    changes_response = requests.get("%s/item/%s/metadata/changes" % (vs_baseurl, item_id),
-                                    auth=(vs_username, vs_password),
-                                    headers={'accept': 'application/json'}
-                                    )
+    rate_limiter.wait()
+    try:
+        changes_response = session.get("%s/item/%s/metadata/changes" % (vs_baseurl, item_id))
+    except requests.RequestException as e:
+        print "Warning: Error on trying to get changes list for Item %s: %s" % (item_id, e)
+        return None
 
     if changes_response.status_code != 200:
         print "Warning: Error on trying to get changes list for Item %s" % item_id
-        return []
+        return None
 
     parsed_response = json.loads(changes_response.text)
     return parsed_response['changeSet']
 
 
-def get_changes_ids_to_remove(user_to_match, metadata_field_name, text_to_match, timestamp_to_match, changes_list):
-    def change_filter_function(change):
-        if change.get('metadata') is None:
-            return False
-
-        change_timestamp = change['metadata'].get('timespan')
-        if not change_timestamp:
-            return False
+class RulesMatcher(object):
+    """
+    Finds the changes matching any of the rules. The rules are indexed by field name and user, so
+    each field change is only compared with the rules for its field and user.
+    """
+    def __init__(self, rules):
+        self.rules_by_field_and_user = collections.defaultdict(list)
+        for rule in rules:
+            self.rules_by_field_and_user[(rule['metadatafield'], rule['user'])].append(rule)
 
-        fields_affected = change_timestamp[0].get('field')
-        if fields_affected is None:
+    def field_change_matches(self, field_change):
+        rules = self.rules_by_field_and_user.get((field_change['name'], field_change['user']))
+        if not rules:
             return False
 
-        for field_change in fields_affected:
-            field_change_name = field_change['name']
-            field_change_timestamp = field_change['timestamp']
-            field_change_user = field_change['user']
-
-            if (field_change_name == metadata_field_name) and \
-                    field_change_timestamp.startswith(timestamp_to_match) and \
-                    (field_change_user == user_to_match):
-
-                field_values = field_change['value']
-                if any(text_to_match in value_change['value'] for value_change in field_values):
-                    return True
+        field_change_timestamp = field_change['timestamp']
+        field_values = field_change['value']
+        for rule in rules:
+            if field_change_timestamp.startswith(rule['date']) and \
+                    any(rule['text'] in value_change['value'] for value_change in field_values):
+                return True
 
         return False
 
-    changes_to_remove = filter(lambda change: change_filter_function(change), changes_list)
-    return [change['id'] for change in changes_to_remove]
+    def get_changes_ids_to_remove(self, changes_list):
+        def change_filter_function(change):
+            if change.get('metadata') is None:
+                return False
 
+            change_timestamp = change['metadata'].get('timespan')
+            if not change_timestamp:
+                return False
 
-all_items_ids = get_all_items_ids()
-data_to_remove = []
-items_qty = len(all_items_ids)
-print ""
-print "Looking for changes in %s items..." % items_qty
+            fields_affected = change_timestamp[0].get('field')
+            if fields_affected is None:
+                return False
 
-for idx, item_id in enumerate(all_items_ids):
-    if idx % 500 == 0:
-        print "> Looking for changes on items: %s/%s" % (idx, items_qty)
+            return any(self.field_change_matches(field_change) for field_change in fields_affected)
 
-    item_changes = get_item_changes(item_id)
+        changes_to_remove = filter(lambda change: change_filter_function(change), changes_list)
+        return [change['id'] for change in changes_to_remove]
 
-    changes_ids_to_remove = get_changes_ids_to_remove(
-        options.user, options.metadatafield,
-        options.text_to_match, options.timestamp, item_changes
-    )
 
-    if changes_ids_to_remove:
-        if dry_run:
-            print ">> Dry Run: Item with ID: '%s' matches the provided arguments, so it has changes to be removed."\
-                  % item_id
+def scan_item(item_id):
+    item_changes = get_item_changes(item_id)
+    if item_changes is None:
+        return None
+
+    return matcher.get_changes_ids_to_remove(item_changes)
+
+
+class StateFile(object):
+    """
+    Saves the progress of a run in a file with one JSON object per line: the options used, the items
+    scanned with the IDs of the changes to remove, and the changes removed.
+
+    Lines are only appended, so the file stays valid if the script is interrupted.
+    """
+    def __init__(self, path):
+        self.criteria = None
+        self.scanned = set()
+        self.matches = collections.OrderedDict()
+        self.removed = set()
+        self.lock = threading.Lock()
+
+        ends_with_newline = True
+        if os.path.exists(path):
+            with open(path) as state_input:
+                for line in state_input:
+                    ends_with_newline = line.endswith('\n')
+                    try:
+                        self.load_record(json.loads(line))
+                    except ValueError:
+                        # Last line is incomplete if the script was killed while writing it
+                        continue
+
+        self.output = open(path, 'a')
+        if not ends_with_newline:
+            self.output.write('\n')
+
+    def load_record(self, record):
+        if 'criteria' in record:
+            self.criteria = record['criteria']
+        elif 'scanned' in record:
+            self.scanned.add(record['scanned'])
+            if record['changes']:
+                self.matches[record['scanned']] = record['changes']
+        elif 'removed' in record:
+            self.removed.add((record['removed'], record['change']))
+
+    def write(self, record):
+        with self.lock:
+            self.output.write(json.dumps(record) + '\n')
+            self.output.flush()
+
+    def save_criteria(self, criteria):
+        self.criteria = criteria
+        self.write({'criteria': criteria})
+
+    def save_scanned(self, item_id, changes_ids):
+        self.write({'scanned': item_id, 'changes': changes_ids})
+
+    def save_removed(self, item_id, change_id):
+        self.write({'removed': item_id, 'change': change_id})
+
+
+def remove_change(item_id, change_id):
+    """
+    Removes a change, returns None on success or the error message.
+    """
+    rate_limiter.wait()
+    try:
+        response = session.delete("%s/item/%s/metadata/changes/%s" % (vs_baseurl, item_id, change_id))
+    except requests.RequestException as e:
+        return str(e)
+
+    if response.status_code != 200:
+        return "HTTP %s" % response.status_code
+
+    return None
+
+
+class ChangesRemover(object):
+    """
+    Removes changes with a number of worker threads. The changes are added to a bounded queue, so the
+    scan can continue while the changes are removed.
+    """
+    def __init__(self, workers):
+        self.queue = Queue.Queue(maxsize=workers * 100)
+        self.end_marker = object()
+        self.lock = threading.Lock()
+        self.removed_qty = 0
+        self.failures = []
+        self.threads = [threading.Thread(target=self.work) for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def add(self, item_id, changes_ids):
+        for change_id in changes_ids:
+            if state and (item_id, change_id) in state.removed:
+                continue
+            self.queue.put((item_id, change_id))
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is self.end_marker:
+                return
+            item_id, change_id = task
+            try:
+                error = remove_change(item_id, change_id)
+                if error is None and state:
+                    state.save_removed(item_id, change_id)
+            except Exception as e:
+                # Keep the thread alive, otherwise the scan blocks adding to the queue once all have died
+                error = "%s: %s" % (type(e).__name__, e)
+            with self.lock:
+                if error is None:
+                    self.removed_qty += 1
+                    if self.removed_qty % 500 == 0:
+                        print "> Removed changes: %s" % self.removed_qty
+                else:
+                    print "Warning: Error on trying to remove change %s on Item %s: %s" % (change_id, item_id, error)
+                    self.failures.append((item_id, change_id, error))
+
+    def finish(self):
+        """
+        Waits until all the added changes have been removed.
+        """
+        for _ in self.threads:
+            self.queue.put(self.end_marker)
+        for thread in self.threads:
+            thread.join()
+
+
+def items_ids_to_scan(items_ids):
+    for item_id in items_ids:
+        if state is None or item_id not in state.scanned:
+            yield item_id
+
+
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+
+    config = ConfigParser.SafeConfigParser()
+    config.read(options.config)
+    vs_username = config.get("vidispine", "VIDISPINE_USERNAME")
+    vs_password = config.get("vidispine", "VIDISPINE_PASSWORD")
+    vs_hostname = config.get("vidispine", "VIDISPINE_URL")
+    vs_port = config.get("vidispine", "VIDISPINE_PORT")
+    vs_baseurl = "%s:%s/API" % (vs_hostname, vs_port)
+
+    if options.rules:
+        if any(getattr(options, option) is not None for option in ['user', 'metadatafield', 'timestamp', 'text_to_match']):
+            parser.error("Options --user, --metadatafield, --date and --text cannot be used with --rules.")
+        try:
+            with open(options.rules) as rules_input:
+                rules = json.load(rules_input)
+        except (IOError, ValueError) as e:
+            parser.error("Cannot read --rules file: %s" % e)
+        if not isinstance(rules, list) or not rules:
+            parser.error("The --rules file should contain a list of rules.")
+        for rule_number, rule in enumerate(rules, 1):
+            if not isinstance(rule, dict):
+                parser.error("Rule %s in --rules file is not an object." % rule_number)
+            rule_error = get_rule_error(rule)
+            if rule_error:
+                parser.error("Rule %s in --rules file: %s" % (rule_number, rule_error))
+    else:
+        rules = [{'user': options.user, 'metadatafield': options.metadatafield,
+                  'date': options.timestamp, 'text': options.text_to_match}]
+        rule_error = get_rule_error(rules[0])
+        if rule_error:
+            parser.error(rule_error)
+
+    if options.dry_run not in [1, 0]:
+        parser.error("Invalid --dry-run option.")
+    dry_run = options.dry_run == 1
+
+    if options.search_first not in [1, 0]:
+        parser.error("Invalid --search-first option.")
+    search_first = options.search_first == 1
+
+    if options.replay not in [1, 0]:
+        parser.error("Invalid --replay option.")
+    replay = options.replay == 1
+    if replay and not (options.state_file and os.path.exists(options.state_file)):
+        parser.error("Option --replay requires an existing --state-file.")
+
+    if options.workers < 1:
+        parser.error("Invalid --workers option, it should be 1 or more.")
+
+    if options.remove_workers < 1:
+        parser.error("Invalid --remove-workers option, it should be 1 or more.")
+
+    if options.max_requests_per_second < 0:
+        parser.error("Invalid --max-requests-per-second option.")
+
+    if options.retries < 0:
+        parser.error("Invalid --retries option.")
+
+    session = create_session(options.workers + options.remove_workers, options.retries)
+    rate_limiter = RateLimiter(options.max_requests_per_second)
+
+    matcher = RulesMatcher(rules)
+
+    state = None
+    if options.state_file:
+        state = StateFile(options.state_file)
+        if state.criteria is None:
+            state.save_criteria(rules)
+        elif state.criteria != rules:
+            parser.error("The --state-file was created with different options: %s" % state.criteria)
+
+    remover = None
+    if not dry_run:
+        print "Removing changes using %s workers..." % options.remove_workers
+        remover = ChangesRemover(options.remove_workers)
+
+    if state:
+        print "%s items already scanned, %s with changes to be removed." % (len(state.scanned), len(state.matches))
+        for item_id, changes_ids_to_remove in state.matches.items():
+            if dry_run:
+                print ">> Dry Run: Item with ID: '%s' matches the provided arguments, so it has changes to be removed."\
+                      % item_id
+            else:
+                remover.add(item_id, changes_ids_to_remove)
+
+    if search_first and not replay and get_unsearchable_texts(rules):
+        print "Warning: Cannot search for the text %s, scanning all items instead of --search-first 1." % \
+              ", ".join(repr(text) for text in get_unsearchable_texts(rules))
+        search_first = False
+
+    if not replay:
+        if search_first:
+            all_items_ids = ItemsIds(get_search_document(rules))
         else:
-            data_to_remove.append((item_id, changes_ids_to_remove))
-
-if dry_run is False:
-    changes_to_remove_qty = len(data_to_remove)
-    print "Removing changes on %s items..." % changes_to_remove_qty
-    for idx, (item_id, changes_ids_to_remove) in enumerate(data_to_remove):
-        if idx % 500 == 0:
-            print "> Removing changes for changes: %s/%s" % (idx, changes_to_remove_qty)
-
-        for change_id in changes_ids_to_remove:
-            requests.delete("%s/item/%s/metadata/changes/%s" % (vs_baseurl, item_id, change_id),
-                            auth=(vs_username, vs_password)
-                            )
-
-print "Done."
+            all_items_ids = ItemsIds()
+        print ""
+        print "Looking for changes%s using %s workers..." % (" in the items found by search" if search_first else "",
+                                                             options.workers)
+
+        for idx, (item_id, changes_ids_to_remove) in enumerate(
+                imap_threaded(scan_item, items_ids_to_scan(all_items_ids), options.workers)):
+            if idx % 500 == 0:
+                print "> Looking for changes on items: %s/%s" % (idx, all_items_ids.hits)
+
+            if changes_ids_to_remove is None:
+                # Failed to get the changes, not saved as scanned so it is retried when resuming
+                continue
+
+            if state:
+                state.save_scanned(item_id, changes_ids_to_remove)
+
+            if changes_ids_to_remove:
+                if dry_run:
+                    print ">> Dry Run: Item with ID: '%s' matches the provided arguments, so it has changes to be removed."\
+                          % item_id
+                else:
+                    remover.add(item_id, changes_ids_to_remove)
+
+    if remover:
+        remover.finish()
+        print ""
+        print "Removed %s changes, %s failed." % (remover.removed_qty, len(remover.failures))
+        for item_id, change_id, error in remover.failures:
+            print "> Failed to remove change %s on Item %s: %s" % (change_id, item_id, error)
+
+    print "Done."
+
+    if remover and remover.failures:
+        sys.exit(1)
@@ -0,0 +1,99 @@
+"""
+Quick and dirty test for the matching and resume logic in remove_specific_items_metadata_changes.py
+"""
+import datetime
+import os
+import shutil
+import tempfile
+
+from remove_specific_items_metadata_changes import RulesMatcher, StateFile, get_date_period, get_rule_error
+
+failures = 0
+
+
+def check(description, value, expected):
+    global failures
+    print "%s -> %r" % (description, value)
+    if value != expected:
+        failures += 1
+        print "******** FAIL: expected %r *********" % (expected,)
+
+
+def change(change_id, *field_changes):
+    return {'id': change_id, 'metadata': {'timespan': [{'field': list(field_changes)}]}}
+
+
+def field_change(name, user, timestamp, *values):
+    return {'name': name, 'user': user, 'timestamp': timestamp, 'value': [{'value': value} for value in values]}
+
+
+for rule, error_expected in [
+    ({'user': 'admin', 'metadatafield': 'portal_mf123456', 'date': '2018-05', 'text': 'foo'}, False),
+    ({'user': 'admin', 'metadatafield': 'portal_mf123456', 'date': '2018-05-08', 'text': ''}, False),
+    ({'user': 'admin', 'metadatafield': 'portal_mf123456', 'date': '2018-13', 'text': 'foo'}, True),
+    ({'user': 'admin', 'metadatafield': 'portal_mf123456', 'date': '2018-1', 'text': 'foo'}, True),
+    ({'user': 'admin', 'metadatafield': 'title', 'date': '2018', 'text': 'foo'}, True),
+    ({'user': 'admin', 'metadatafield': 'portal_mf123456', 'date': '2018'}, True),
+    ({'user': 'admin', 'metadatafield': 'portal_mf123456', 'date': '2018', 'text': 1}, True),
+]:
+    check("get_rule_error(%r) is an error" % rule, bool(get_rule_error(rule)), error_expected)
+
+for timestamp, expected in [
+    ('2018', (datetime.datetime(2018, 1, 1), datetime.datetime(2019, 1, 1))),
+    ('2018-12', (datetime.datetime(2018, 12, 1), datetime.datetime(2019, 1, 1))),
+    ('2020-02', (datetime.datetime(2020, 2, 1), datetime.datetime(2020, 3, 1))),
+    ('2018-12-31', (datetime.datetime(2018, 12, 31), datetime.datetime(2019, 1, 1))),
+    ('2020-02-28', (datetime.datetime(2020, 2, 28), datetime.datetime(2020, 2, 29))),
+]:
+    check("get_date_period(%r)" % timestamp, get_date_period(timestamp), expected)
+
+matcher = RulesMatcher([
+    {'user': 'admin', 'metadatafield': 'portal_mf123456', 'date': '2018-05', 'text': 'foo'},
+    {'user': 'bob', 'metadatafield': 'portal_mf654321', 'date': '2018-05-08', 'text': 'bar'},
+    {'user': 'admin', 'metadatafield': 'portal_mf123456', 'date': '2019', 'text': 'baz'},
+])
+change_set = [
+    change('VX-1', field_change('portal_mf123456', 'admin', '2018-05-31T23:59:59.000+0000', 'xx foo xx')),
+    # Text of the first rule, date of the third
+    change('VX-2', field_change('portal_mf123456', 'admin', '2019-05-01T00:00:00.000+0000', 'foo')),
+    change('VX-3', field_change('portal_mf123456', 'admin', '2019-01-01T00:00:00.000+0000', 'other', 'baz')),
+    # User of the first rule with the field of the second
+    change('VX-4', field_change('portal_mf654321', 'admin', '2018-05-08T10:00:00.000+0000', 'bar')),
+    change('VX-5', field_change('portal_mf123456', 'bob', '2018-05-08T10:00:00.000+0000', 'foo'),
+           field_change('portal_mf654321', 'bob', '2018-05-08T10:00:00.000+0000', 'a bar')),
+    change('VX-6', field_change('portal_mf654321', 'bob', '2018-05-09T00:00:00.000+0000', 'bar')),
+    change('VX-7', field_change('portal_mf123456', 'admin', '2018-06-01T00:00:00.000+0000', 'foo')),
+    # Changes without field changes, e.g. of the item's groups
+    {'id': 'VX-8', 'metadata': {'timespan': [{'group': []}]}},
+    {'id': 'VX-9'},
+]
+check("get_changes_ids_to_remove", matcher.get_changes_ids_to_remove(change_set), ['VX-1', 'VX-3', 'VX-5'])
+
+tmpdir = tempfile.mkdtemp()
+try:
+    state_path = os.path.join(tmpdir, 'state.jsonl')
+    with open(state_path, 'w') as state_output:
+        state_output.write('{"criteria": [{"text": "foo"}]}\n'
+                           '{"scanned": "VX-1", "changes": ["VX-10", "VX-11"]}\n'
+                           '{"scanned": "VX-2", "changes": []}\n'
+                           '{"removed": "VX-1", "change": "VX-10"}\n'
+                           # Killed while writing the last line
+                           '{"scanned": "VX-3", "chan')
+    state = StateFile(state_path)
+    check("criteria", state.criteria, [{'text': 'foo'}])
+    check("scanned", state.scanned, {'VX-1', 'VX-2'})
+    check("matches", dict(state.matches), {'VX-1': ['VX-10', 'VX-11']})
+    check("removed", state.removed, {('VX-1', 'VX-10')})
+
+    state.save_scanned('VX-3', ['VX-30'])
+    state.save_removed('VX-1', 'VX-11')
+    state.output.close()
+    state = StateFile(state_path)
+    check("scanned after reload", state.scanned, {'VX-1', 'VX-2', 'VX-3'})
+    check("matches after reload", dict(state.matches), {'VX-1': ['VX-10', 'VX-11'], 'VX-3': ['VX-30']})
+    check("removed after reload", state.removed, {('VX-1', 'VX-10'), ('VX-1', 'VX-11')})
+    state.output.close()
+finally:
+    shutil.rmtree(tmpdir)
+
+print "%s failures" % failures